@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# Records Twitch chat traffic and replays it against the bot offline, to reproduce what a raid does to the handlers.
+#
+#   chat_replay.py record LOG CHANNEL [CHANNEL ...] [--seconds N]   read-only anonymous login, no token needed
+#   chat_replay.py raid LOG [--messages 30000] [--chatters 5000]    a synthetic raid when there is no recording
+#   chat_replay.py replay LOG [--speed 1|10|0]                      0 replays as fast as the bot keeps up
+#
+# A log holds the raw lines the bot would have received (PRIVMSG with tags, JOIN, PART and NAMES), each with its
+# offset from the start in milliseconds, gzipped when the name ends in .gz. Replays go through a fake IRC server, so
+# parsing and dispatch are part of the timings. Helix, pronouns and OpenAI are the fakes from fake_twitch.py.
+# Every on_pubmsg, on_join, on_part and on_namreply call is timed and reported as a histogram per handler.
+import argparse
+import gzip
+import os
+import random
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_twitch import EMOTES, FakeEventSub, FakeIrc, FakeServices, privmsg_line, user_prefix
+from pywiki_lite import BotCore, BotSettings, TwitchBot
+
+HEADER = '#pywiki-chat-log 1'
+RECORDED = {'PRIVMSG', 'JOIN', 'PART', '353', '366'}
+HANDLERS = {'PRIVMSG': 'on_pubmsg', 'JOIN': 'on_join', 'PART': 'on_part', '353': 'on_namreply'}
+# Histogram bucket upper bounds in microseconds
+BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, float('inf')]
+
+
+def open_log(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def read_log(path):
+    with open_log(path, 'r') as log:
+        if log.readline().strip() != HEADER:
+            raise ValueError(path + ' is not a chat log')
+        for line in log:
+            offset, _, raw = line.rstrip('\n').partition('\t')
+            yield int(offset), raw
+
+
+def command_of(line):
+    # The IRC command of a raw line, after the optional tags and prefix
+    parts = line.split(' ', 3)
+    index = 0
+    if parts[index].startswith('@'):
+        index += 1
+    if index < len(parts) and parts[index].startswith(':'):
+        index += 1
+    return parts[index] if index < len(parts) else ''
+
+
+def record(args):
+    host, port = (args.server or BotSettings.DEFAULT_ENDPOINTS['irc']).rsplit(':', 1)
+    nick = 'justinfan' + str(random.randint(10000, 99999))
+    channels = ['#' + channel.lstrip('#').lower() for channel in args.channels]
+    connection = socket.create_connection((host, int(port)))
+    connection.sendall(('CAP REQ :twitch.tv/tags twitch.tv/membership twitch.tv/commands\r\nPASS SCHMOOPIIE\r\n'
+                        'NICK ' + nick + '\r\nJOIN ' + ','.join(channels) + '\r\n').encode())
+
+    start = time.monotonic()
+    lines = 0
+    buffer = b''
+    with open_log(args.log, 'w') as log:
+        log.write(HEADER + '\n')
+        try:
+            while not args.seconds or time.monotonic() - start < args.seconds:
+                # Wake up every second so --seconds is honored in a quiet channel
+                if not select.select([connection], [], [], 1)[0]:
+                    continue
+                data = connection.recv(65536)
+                if not data:
+                    print('Twitch closed the connection')
+                    break
+                *received, buffer = (buffer + data).split(b'\r\n')
+                for line in received:
+                    line = line.decode('utf-8', 'replace')
+                    if line.startswith('PING'):
+                        connection.sendall(('PONG' + line[4:] + '\r\n').encode())
+                        continue
+                    command = command_of(line)
+                    # Our own JOIN would replay as a stranger joining
+                    if command not in RECORDED or (command == 'JOIN' and line.startswith(':' + nick + '!')):
+                        continue
+                    log.write(str(int((time.monotonic() - start) * 1000)) + '\t' + line + '\n')
+                    lines += 1
+                    if lines % 1000 == 0:
+                        print(str(lines) + ' lines recorded')
+        except KeyboardInterrupt:
+            pass
+    connection.close()
+    print('Recorded ' + str(lines) + ' lines in ' + format(time.monotonic() - start, '.0f') + ' s to ' + args.log)
+
+
+def raid(args):
+    # A channel idling with a few chatters, then a raid: a JOIN flood and a burst of chat from the raiders
+    rng = random.Random(args.seed)
+    channel = '#' + args.channel
+    regulars = ['regular' + str(index) for index in range(50)]
+    raiders = ['raider' + str(index) for index in range(args.chatters)]
+    events = [(0, ':recorder.tmi.twitch.tv 353 recorder = ' + channel + ' :' + ' '.join(regulars)),
+              (0, ':recorder.tmi.twitch.tv 366 recorder ' + channel + ' :End of /NAMES list')]
+    raid_at = 5000
+    for index, login in enumerate(raiders):
+        # Twitch batches JOINs, they arrive over the first ten seconds of the raid
+        events.append((raid_at + index * 10000 // len(raiders), user_prefix(login) + ' JOIN ' + channel))
+    span = args.seconds * 1000
+    for index in range(args.messages):
+        offset = raid_at + index * span // args.messages
+        login = rng.choice(raiders) if rng.random() < 0.9 else rng.choice(regulars)
+        text = ' '.join(rng.choice(EMOTES) for _ in range(rng.randint(1, 6)))
+        if rng.random() < 0.1:
+            text = 'RAID ' + text + ' welcome everyone'
+        events.append((offset, privmsg_line(channel, login, text, 'm' + str(index), 1.7e9 + offset / 1000)))
+    for login in rng.sample(raiders, len(raiders) // 4):
+        events.append((raid_at + span + rng.randint(0, 10000), user_prefix(login) + ' PART ' + channel))
+    events.sort(key=lambda event: event[0])
+
+    with open_log(args.log, 'w') as log:
+        log.write(HEADER + '\n')
+        for offset, line in events:
+            log.write(str(offset) + '\t' + line + '\n')
+    print('Wrote ' + str(len(events)) + ' lines covering ' + format(events[-1][0] / 1000, '.0f') + ' s to ' + args.log)
+
+
+def histogram(name, timings):
+    # The report lines for one handler's call timings
+    timings = sorted(timings)
+    counts = [0] * len(BUCKETS)
+    for seconds in timings:
+        micros = seconds * 1e6
+        counts[next(index for index, bound in enumerate(BUCKETS) if micros < bound)] += 1
+    lines = [name + '  ' + str(len(timings)) + ' calls, ' + format(sum(timings), '.2f') + ' s total, p50 '
+             + format(timings[len(timings) // 2] * 1e6, '.0f') + ' us, p99 '
+             + format(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6, '.0f') + ' us, max '
+             + format(timings[-1] * 1e3, '.1f') + ' ms']
+    widest = max(counts)
+    for bound, count in zip(BUCKETS, counts):
+        if not count:
+            continue
+        if bound == float('inf'):
+            label = '>=' + format(BUCKETS[-2] / 1000, 'g') + ' ms'
+        else:
+            label = '<' + (str(bound) + ' us' if bound < 1000 else format(bound / 1000, 'g') + ' ms')
+        bar = '#' * max(1, 40 * count // widest)
+        lines.append('  ' + label.rjust(9) + ' ' + bar.ljust(40) + ' ' + str(count))
+    return lines
+
+
+def replay(args):
+    lines = list(read_log(args.log))
+    channels = sorted({line.split(' ')[3 if line.startswith('@') else 2].split(',')[0] for _, line in lines
+                       if command_of(line) in ('PRIVMSG', 'JOIN', 'PART')})
+    expected = {}
+    for _, line in lines:
+        handler = HANDLERS.get(command_of(line))
+        if handler:
+            expected[handler] = expected.get(handler, 0) + 1
+
+    timings = {handler: [] for handler in HANDLERS.values()}
+    timing = threading.Event()
+
+    def timed(name, handler):
+        def timed_handler(self, c, e):
+            start = time.perf_counter()
+            handler(self, c, e)
+            if timing.is_set():
+                timings[name].append(time.perf_counter() - start)
+        return timed_handler
+    for handler in HANDLERS.values():
+        setattr(TwitchBot, handler, timed(handler, getattr(TwitchBot, handler)))
+
+    irc = FakeIrc(args.username, moderator=True)
+    services = FakeServices(args.http_latency, args.openai_latency, 0, 20)
+    events = FakeEventSub()
+    settings = BotSettings()
+    settings.username = args.username
+    settings.channel = ','.join(channel[1:] for channel in channels)
+    settings.openai_api_key = 'fake'
+    settings.model = 'gpt-4'
+    settings.frequency = args.frequency
+    settings.endpoints.update(services.endpoints(), irc=irc.address, eventsub=events.url)
+
+    report = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    def show(line=''):
+        print(line, file=report)
+
+    core = BotCore(settings, os.path.join(tempfile.mkdtemp(), 'config.ini'))
+    core.start()
+    threading.Thread(target=core.run_bot, daemon=True).start()
+    started = time.perf_counter()
+    while len(irc.channels) < len(channels) and time.perf_counter() - started < 60:
+        time.sleep(0.05)
+    # Let the bot's own JOIN and NAMES go through before timing starts
+    time.sleep(1)
+    timing.set()
+
+    show('Replaying ' + str(len(lines)) + ' lines to ' + str(len(channels)) + ' channel(s) at '
+         + (str(args.speed) + 'x' if args.speed else 'full speed'))
+    behind = 0
+    start = time.perf_counter()
+    for offset, line in lines:
+        if args.speed:
+            due = start + offset / 1000 / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+        irc.send(line)
+    sent_for = time.perf_counter() - start
+
+    deadline = time.perf_counter() + 120
+    while (any(len(timings[handler]) < count for handler, count in expected.items())
+           and time.perf_counter() < deadline):
+        time.sleep(0.05)
+    handled_for = time.perf_counter() - start
+    handled = sum(len(calls) for calls in timings.values())
+
+    show('Sent in ' + format(sent_for, '.2f') + ' s, most behind schedule ' + format(behind * 1000, '.0f')
+         + ' ms, handled ' + str(handled) + ' of ' + str(sum(expected.values())) + ' events in '
+         + format(handled_for, '.2f') + ' s (' + format(handled / handled_for, '.0f') + ' events/s)')
+    for handler, calls in timings.items():
+        if calls:
+            show()
+            for line in histogram(handler, calls):
+                show(line)
+    show()
+    show('Replies ' + str(core.bot.scheduler.stats()))
+    show('Sent    ' + str(core.bot.send_queue.stats()))
+
+    core.stop()
+    core.close()
+    os._exit(0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Record Twitch chat and replay it against the bot offline')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recorder = commands.add_parser('record', help='record live chat from one or more channels')
+    recorder.add_argument('log')
+    recorder.add_argument('channels', nargs='+')
+    recorder.add_argument('--seconds', type=float, default=0, help='stop after this long, 0 records until Ctrl-C')
+    recorder.add_argument('--server', help='IRC server as host:port')
+
+    generator = commands.add_parser('raid', help='write a synthetic raid')
+    generator.add_argument('log')
+    generator.add_argument('--channel', default='raided')
+    generator.add_argument('--messages', type=int, default=30000)
+    generator.add_argument('--chatters', type=int, default=5000)
+    generator.add_argument('--seconds', type=int, default=300, help='how long the raiders keep chatting')
+    generator.add_argument('--seed', type=int, default=1)
+
+    replayer = commands.add_parser('replay', help='replay a log against the bot')
+    replayer.add_argument('log')
+    replayer.add_argument('--speed', type=float, default=1, help='1 is real time, 10 ten times faster, 0 unpaced')
+    replayer.add_argument('--username', default='replaybot')
+    replayer.add_argument('--frequency', type=float, default=0, help='percent of chat the bot replies to')
+    replayer.add_argument('--http-latency', type=float, default=0.05)
+    replayer.add_argument('--openai-latency', type=float, default=0, help='the stubbed completion latency')
+    replayer.add_argument('--verbose', action='store_true', help='show what the bot prints while it runs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    {'record': record, 'raid': raid, 'replay': replay}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# End to end load test: the real bot against local fakes of Twitch IRC, Helix, EventSub, pronouns and OpenAI
+# (see fake_twitch.py), so throughput and reply latency can be measured without going live or paying for tokens.
+# Scripted chat is offered at --rate messages per second spread over --channels channels; every --mention-every
+# message mentions the bot and asks for a reply. Reported: messages handled per second and how long on_pubmsg took to
+# get to them, time to reply percentiles (chat message sent -> reply PRIVMSG received), threads and RSS.
+# The fakes share the process, their threads and memory are taken before the bot starts and left out.
+# --throughput is the chat handling preset: 500 msgs/s for 10 s, every chatter new so each message triggers user and
+# pronoun lookups, whole completions. Flags given with it still win.
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_twitch import FakeEventSub, FakeIrc, FakeServices, MARKER
+from pywiki_lite import BotCore, BotSettings, TwitchBot
+
+USERNAME = 'benchbot'
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        # Peak rather than current, Unix only
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def milliseconds(values):
+    return ', '.join(name + ' ' + format(percentile(values, fraction) * 1000, '.1f') + ' ms'
+                     for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)))
+
+
+THROUGHPUT = {'rate': 500, 'seconds': 10, 'chatters': 0, 'no_stream': True}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the bot against local fake Twitch and OpenAI servers')
+    parser.add_argument('--throughput', action='store_true', help='preset for chat handling throughput, see above')
+    parser.add_argument('--rate', type=float, default=200, help='chat messages offered per second')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to offer chat for')
+    parser.add_argument('--channels', type=int, default=1, help='channels the bot joins')
+    parser.add_argument('--chatters', type=int, default=2000,
+                        help='distinct chatters the messages come from, 0 for a new one every message')
+    parser.add_argument('--mention-every', type=int, default=10, help='every Nth message asks the bot for a reply')
+    parser.add_argument('--http-latency', type=float, default=0.05, help='seconds per Helix and pronoun request')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds to the first completion token')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='seconds between streamed tokens')
+    parser.add_argument('--reply-words', type=int, default=30, help='words in each fake completion')
+    parser.add_argument('--no-stream', action='store_true', help='ask for whole completions instead of streams')
+    parser.add_argument('--model', default='gpt-4')
+    parser.add_argument('--reply-workers', type=int, default=2)
+    parser.add_argument('--moderator', action='store_true', help='the bot is a moderator and may send faster')
+    parser.add_argument('--verbose', action='store_true', help='show what the bot prints while it runs')
+    parser.add_argument('--profile', type=float, default=0, help='sample every thread for this many seconds of load')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve metrics here and show a scrape at the end')
+    if parser.parse_known_args()[0].throughput:
+        parser.set_defaults(**THROUGHPUT)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    asked = {}
+    replies = {}
+
+    def on_reply(channel, text, received):
+        marker = MARKER.search(text)
+        if marker and marker.group() in asked and marker.group() not in replies:
+            replies[marker.group()] = received - asked[marker.group()]
+
+    irc = FakeIrc(USERNAME, on_reply, args.moderator)
+    services = FakeServices(args.http_latency, args.openai_latency, args.token_interval, args.reply_words)
+    events = FakeEventSub()
+
+    # on_pubmsg is timed from the message being written to it returning
+    written = {}
+    handled = []
+    on_pubmsg = TwitchBot.on_pubmsg
+
+    def timed_on_pubmsg(self, c, e):
+        on_pubmsg(self, c, e)
+        message_id = next((tag['value'] for tag in e.tags if tag['key'] == 'id'), None)
+        if message_id in written:
+            handled.append(time.perf_counter() - written[message_id])
+    TwitchBot.on_pubmsg = timed_on_pubmsg
+
+    channels = ['#bench' + str(index) for index in range(args.channels)]
+    settings = BotSettings()
+    settings.username = USERNAME
+    settings.channel = ','.join(channel[1:] for channel in channels)
+    settings.openai_api_key = 'fake'
+    settings.model = args.model
+    settings.frequency = 0
+    settings.reply_workers = args.reply_workers
+    settings.stream_replies = 0 if args.no_stream else 1
+    settings.context = 'You are <name> in <channel>, talking to <author> (<chatter_pronouns>). Users: <users>.'
+    settings.endpoints.update(services.endpoints(), irc=irc.address, eventsub=events.url)
+    settings.metrics_port = args.metrics_port
+
+    # The bot prints every chat line, which would bury the report
+    report = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    def show(line):
+        print(line, file=report)
+
+    base_threads = threading.active_count()
+    base_rss = rss_mb()
+    directory = tempfile.mkdtemp()
+    core = BotCore(settings, os.path.join(directory, 'config.ini'))
+    started = time.perf_counter()
+    core.start()
+    threading.Thread(target=core.run_bot, daemon=True).start()
+    if not irc.joined.wait(60):
+        show('The bot never joined')
+        os._exit(1)
+    while len(irc.channels) < len(channels) and time.perf_counter() - started < 60:
+        time.sleep(0.05)
+    started_for = time.perf_counter() - started
+
+    def chatter(index):
+        return 'chatter' + str(index * 7919 % args.chatters if args.chatters else index)
+
+    threads = []
+    rss = []
+    total = int(args.rate * args.seconds)
+    profile = core.profile(args.profile) if args.profile else None
+    start = time.perf_counter()
+    for index in range(total):
+        delay = start + index / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+            threads.append(threading.active_count() - base_threads)
+            rss.append(rss_mb() - base_rss)
+        login = chatter(index)
+        channel = channels[index % len(channels)]
+        if args.mention_every and index % args.mention_every == 0:
+            marker = 'q' + str(index)
+            text = USERNAME + ' what do you think about ' + marker
+            asked[marker] = time.perf_counter()
+        else:
+            text = 'message ' + str(index) + ' Kappa'
+        message_id = str(index)
+        written[message_id] = time.perf_counter()
+        irc.chat(channel, login, text, message_id)
+    offered_for = time.perf_counter() - start
+
+    # Let the bot catch up with chat, then give outstanding replies time to arrive
+    while len(handled) < total and time.perf_counter() - start < args.seconds * 6:
+        time.sleep(0.05)
+    handled_for = time.perf_counter() - start
+    deadline = time.perf_counter() + args.openai_latency * 4 + args.reply_words * args.token_interval + 5
+    while len(replies) < len(asked) and time.perf_counter() < deadline:
+        time.sleep(0.05)
+        threads.append(threading.active_count() - base_threads)
+        rss.append(rss_mb() - base_rss)
+
+    show('bot started in  ' + format(started_for, '.2f') + ' s')
+    show('offered         ' + str(total) + ' msgs in ' + format(offered_for, '.2f') + ' s to '
+          + str(len(channels)) + ' channel(s)')
+    show('handled         ' + str(len(handled)) + ' msgs, ' + format(len(handled) / handled_for, '.0f')
+          + ' msgs/s')
+    show('handling lag    ' + milliseconds(handled))
+    show('replies         ' + str(len(replies)) + ' of ' + str(len(asked)) + ' asked for')
+    show('time to reply   ' + milliseconds(list(replies.values())))
+    show('scheduler       ' + str(core.bot.scheduler.stats()))
+    logins = set(chatter(index) for index in range(total))
+    show('pronouns        ' + str(sum(core.cache.get('pronouns', login) is not None for login in logins)) + ' of '
+          + str(len(logins)) + ' chatters cached')
+    show('send queue      ' + str(core.bot.send_queue.stats()))
+    show('bot threads     peak ' + str(max(threads, default=0)))
+    show('bot RSS         peak ' + format(max(rss, default=0), '.1f') + ' MB over ' + format(base_rss, '.1f')
+          + ' MB before start')
+    show('fake requests   ' + ', '.join(path + ' ' + str(count) for path, count in sorted(services.requests.items())))
+    if profile is not None:
+        core.profiler.thread.join()
+        show('profile         ' + profile)
+    show('')
+    show(core.latency.report())
+    if args.metrics_port:
+        show('')
+        with urllib.request.urlopen('http://127.0.0.1:' + str(args.metrics_port) + '/metrics') as response:
+            show(response.read().decode().rstrip())
+
+    core.stop()
+    core.close()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
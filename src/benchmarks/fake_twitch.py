@@ -0,0 +1,349 @@
+#!/usr/bin/python
+# Local stand-ins for everything the bot talks to, so it can be load tested without Twitch or OpenAI.
+# FakeIrc speaks enough of Twitch IRC for the bot: the membership, tags and commands capabilities it requests in
+# on_welcome, JOIN with NAMES, PING and PRIVMSG. FakeServices answers the OAuth, Helix, pronoun, launch and chat
+# completion requests with a configurable latency, and FakeEventSub sends the EventSub welcome over a websocket.
+# Point BotSettings.endpoints at their urls.
+import base64
+import hashlib
+import http.server
+import itertools
+import json
+import re
+import socketserver
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+EMOTES = ['Kappa', 'PogChamp', 'LUL', 'BibleThump', 'Kreygasm', 'ResidentSleeper', 'SeemsGood', 'NotLikeThis']
+# Replies echo this marker from the chatter's message so the reply can be matched to what asked for it
+MARKER = re.compile(r'\bq\d+\b')
+
+
+def user_id(login):
+    return str(1000 + int(hashlib.md5(login.encode()).hexdigest()[:8], 16))
+
+
+def user_prefix(login):
+    return ':' + login + '!' + login + '@' + login + '.tmi.twitch.tv'
+
+
+def privmsg_line(channel, login, text, message_id, sent_at=None, tags=True):
+    # A chat message the way Twitch relays it with the tags capability
+    line = user_prefix(login) + ' PRIVMSG ' + channel + ' :' + text
+    if not tags:
+        return line
+    return ('@badge-info=;badges=;color=;display-name=' + login.capitalize() + ';emotes=;first-msg=0;flags=;id='
+            + message_id + ';mod=0;returning-chatter=0;room-id=' + user_id(channel[1:]) + ';subscriber=0;'
+            'tmi-sent-ts=' + str(int((sent_at or time.time()) * 1000)) + ';turbo=0;user-id=' + user_id(login)
+            + ';user-type= ' + line)
+
+
+class FakeIrc:
+    """A Twitch IRC server for one bot connection. A moderator bot gets Twitch's higher send rate limit."""
+
+    def __init__(self, username, on_reply=None, moderator=False):
+        self.username = username.lower()
+        self.on_reply = on_reply
+        self.moderator = moderator
+        self.caps = set()
+        self.channels = set()
+        self.chatters = set()
+        self.joined = threading.Event()
+        self.client = None
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake.client = self
+                for raw in self.rfile:
+                    fake.receive(raw.decode('utf-8', 'replace').strip())
+                fake.client = None
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:' + str(self.server.server_address[1])
+
+    def send(self, line):
+        client = self.client
+        if client is None:
+            return False
+        with self.lock:
+            try:
+                client.wfile.write((line + '\r\n').encode())
+                client.wfile.flush()
+            except OSError:
+                return False
+        return True
+
+    def receive(self, line):
+        command, _, rest = line.partition(' ')
+        if command == 'CAP' and rest.startswith('REQ'):
+            capabilities = rest.split(':', 1)[1]
+            self.caps.update(capabilities.split())
+            self.send(':tmi.twitch.tv CAP * ACK :' + capabilities)
+        elif command == 'NICK':
+            for number, text in (('001', 'Welcome, GLHF!'), ('002', 'Your host is tmi.twitch.tv'),
+                                 ('003', 'This server is rather new'), ('004', '-'), ('375', '-'),
+                                 ('372', 'You are in a maze of twisty passages, all alike.'), ('376', '>')):
+                self.send(':tmi.twitch.tv ' + number + ' ' + self.username + ' :' + text)
+        elif command == 'JOIN':
+            for channel in rest.split(','):
+                self.join(channel.strip())
+        elif command == 'PING':
+            self.send(':tmi.twitch.tv PONG tmi.twitch.tv ' + rest)
+        elif command == 'PRIVMSG':
+            channel, _, text = rest.partition(' :')
+            if self.on_reply is not None:
+                self.on_reply(channel, text, time.perf_counter())
+
+    def join(self, channel):
+        self.send(user_prefix(self.username) + ' JOIN ' + channel)
+        self.send(':' + self.username + '.tmi.twitch.tv 353 ' + self.username + ' = ' + channel + ' :'
+                  + self.username)
+        self.send(':' + self.username + '.tmi.twitch.tv 366 ' + self.username + ' ' + channel
+                  + ' :End of /NAMES list')
+        if 'twitch.tv/commands' in self.caps:
+            self.send('@badges=' + ('moderator/1' if self.moderator else '') + ';color=;display-name='
+                      + self.username + ';mod=' + ('1' if self.moderator else '0') + ';subscriber=0 :tmi.twitch.tv '
+                      'USERSTATE ' + channel)
+        self.channels.add(channel)
+        self.joined.set()
+
+    def chat(self, channel, login, text, message_id=None, sent_at=None):
+        # Says text in the channel as login, the way Twitch would relay it to the bot. Returns the message id.
+        message_id = message_id or str(uuid.uuid4())
+        if login not in self.chatters:
+            self.chatters.add(login)
+            # With the membership capability Twitch also tells the bot who joined
+            if 'twitch.tv/membership' in self.caps:
+                self.send(user_prefix(login) + ' JOIN ' + channel)
+        self.send(privmsg_line(channel, login, text, message_id, sent_at, 'twitch.tv/tags' in self.caps))
+        return message_id
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeServices:
+    """OAuth, Helix, pronouns, launches and OpenAI chat completions on one local HTTP server.
+
+    Every request waits http_latency seconds. A chat completion waits openai_latency seconds for its first token,
+    then streams reply_words words token_interval seconds apart, or answers all at once if it wasn't streamed.
+    """
+
+    def __init__(self, http_latency=0.05, openai_latency=0.3, token_interval=0.01, reply_words=30):
+        self.http_latency = http_latency
+        self.openai_latency = openai_latency
+        self.token_interval = token_interval
+        self.reply_words = reply_words
+        # path -> requests served
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake.handle(self, 'GET')
+
+            def do_POST(self):
+                fake.handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        # Clients hanging up mid request is part of the test, not an error
+        self.server.handle_error = lambda request, address: None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def endpoints(self):
+        return {
+            'auth': self.url + '/oauth2',
+            'helix': self.url + '/helix',
+            'pronouns': self.url + '/api',
+            'launches': self.url + '/2.2.0',
+            'igdb': self.url + '/v4',
+            'openai': self.url + '/v1',
+        }
+
+    def handle(self, request, method):
+        url = urlsplit(request.path)
+        query = parse_qs(url.query)
+        body = request.rfile.read(int(request.headers.get('Content-Length') or 0))
+        # Pronouns are looked up per login, count them together
+        path = '/api/users/*' if url.path.startswith('/api/users/') else url.path
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+        if url.path == '/v1/chat/completions':
+            self.complete(request, json.loads(body))
+            return
+        time.sleep(self.http_latency)
+        status, data = 200, {}
+        if url.path == '/oauth2/token':
+            data = {'access_token': 'token', 'refresh_token': 'refresh', 'expires_in': 14400}
+        elif url.path == '/oauth2/validate':
+            data = {'client_id': 'client', 'login': 'bot', 'user_id': user_id('bot'), 'expires_in': 14400}
+        elif url.path == '/helix/users':
+            data = {'data': [{'id': user_id(login), 'login': login, 'display_name': login.capitalize(),
+                              'created_at': '2020-01-01T00:00:00Z'} for login in query.get('login', [])]}
+        elif url.path == '/helix/channels':
+            data = {'data': [{'broadcaster_id': channel_id, 'game_name': 'Chess', 'game_id': '743',
+                              'title': 'Load test'} for channel_id in query.get('broadcaster_id', [])]}
+        elif url.path == '/helix/chat/emotes/global':
+            data = {'data': [{'id': str(index), 'name': name} for index, name in enumerate(EMOTES)]}
+        elif url.path == '/helix/eventsub/subscriptions':
+            status, data = 202, {'data': [{'id': str(uuid.uuid4()), 'status': 'enabled'}]}
+        elif url.path == '/helix/search/channels':
+            data = {'data': [{'id': user_id(query['query'][0]), 'broadcaster_login': query['query'][0],
+                              'game_name': 'Chess', 'is_live': True, 'started_at': '2020-01-01T00:00:00Z'}]}
+        elif url.path == '/helix/channels/followers':
+            data = {'total': 1, 'data': [{'followed_at': '2021-01-01T00:00:00Z'}]}
+        elif url.path.startswith('/api/users/'):
+            data = [{'login': url.path.rsplit('/', 1)[1], 'pronoun_id': 'theythem'}]
+        elif url.path.startswith('/2.2.0/launch/'):
+            data = {'results': [{'name': 'Falcon 9 | Starlink', 'net': '2024-01-01T00:00:00Z'}]}
+        elif url.path == '/v4/games':
+            data = [{'id': 1, 'name': 'Chess', 'summary': 'A board game'}]
+        else:
+            status = 404
+        self.respond(request, status, json.dumps(data).encode())
+
+    def respond(self, request, status, content, content_type='application/json'):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    def reply_for(self, messages):
+        asked = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), '')
+        marker = MARKER.search(asked)
+        words = ['Sure', 'about', marker.group() if marker else 'that'] + list(
+            itertools.islice(itertools.cycle(['and', 'chess', 'is', 'a', 'fun', 'game', 'to', 'watch']),
+                             max(0, self.reply_words - 3)))
+        return words
+
+    def complete(self, request, body):
+        words = self.reply_for(body['messages'])
+        time.sleep(self.openai_latency)
+        if not body.get('stream'):
+            content = ' '.join(words) + '.'
+            data = {'id': 'chatcmpl-fake', 'object': 'chat.completion', 'model': body['model'],
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': len(words), 'total_tokens': len(words)}}
+            self.respond(request, 200, json.dumps(data).encode())
+            return
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Connection', 'close')
+        request.end_headers()
+        request.close_connection = True
+        try:
+            for index, word in enumerate(words + ['.']):
+                if index:
+                    time.sleep(self.token_interval)
+                token = word if index == 0 or word == '.' else ' ' + word
+                chunk = {'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+                request.wfile.write(b'data: ' + json.dumps(chunk).encode() + b'\n\n')
+                request.wfile.flush()
+            request.wfile.write(b'data: [DONE]\n\n')
+            request.wfile.flush()
+        except OSError:
+            # The bot hung up once the reply was long enough
+            pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeEventSub:
+    """Accepts EventSub websocket connections and sends each one a session_welcome."""
+
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    def __init__(self):
+        fake = self
+        self.sessions = 0
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake.serve(self)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'ws://127.0.0.1:' + str(self.server.server_address[1]) + '/ws'
+
+    def serve(self, handler):
+        headers = {}
+        for raw in handler.rfile:
+            line = raw.decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + self.GUID).encode()).digest())
+        handler.wfile.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        self.sessions += 1
+        welcome = {'metadata': {'message_id': str(uuid.uuid4()), 'message_type': 'session_welcome'},
+                   'payload': {'session': {'id': str(uuid.uuid4()), 'status': 'connected',
+                                           'keepalive_timeout_seconds': 600}}}
+        self.send_frame(handler, 1, json.dumps(welcome).encode())
+
+        while True:
+            header = handler.rfile.read(2)
+            if len(header) < 2:
+                return
+            opcode, length = header[0] & 0x0f, header[1] & 0x7f
+            if length == 126:
+                length = int.from_bytes(handler.rfile.read(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(handler.rfile.read(8), 'big')
+            mask = handler.rfile.read(4) if header[1] & 0x80 else b'\0\0\0\0'
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(handler.rfile.read(length)))
+            if opcode == 8:
+                self.send_frame(handler, 8, payload[:2])
+                return
+            if opcode == 9:
+                self.send_frame(handler, 10, payload)
+
+    @staticmethod
+    def send_frame(handler, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, 'big')
+        handler.wfile.write(header + payload)
+        handler.wfile.flush()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
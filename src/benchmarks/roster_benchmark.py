@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# Per chat message cost of the roster check at growing chatter counts.
+# "listbox" reproduces the old check, str() of every Listbox entry searched for the author,
+# "roster" is what on_pubmsg does now.
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pywiki_lite import Roster
+
+
+def listbox_check(entries, author):
+    if author not in str(entries):
+        entries = entries + (author,)
+    return entries
+
+
+def main():
+    messages = 2000
+    print('chatters   listbox us/msg   roster us/msg')
+    for chatters in (100, 1000, 10000):
+        logins = ['chatter' + str(i) for i in range(chatters)]
+        entries = tuple(logins)
+        roster = Roster()
+        for login in logins:
+            roster.add(login)
+
+        authors = [logins[i * 7919 % chatters] for i in range(messages)]
+        listbox_time = timeit.timeit(lambda: [listbox_check(entries, author) for author in authors], number=1)
+        roster_time = timeit.timeit(lambda: [roster.seen(author) for author in authors], number=1)
+        print(f'{chatters:>8}   {listbox_time / messages * 1e6:>14.2f}   {roster_time / messages * 1e6:>13.2f}')
+
+
+if __name__ == "__main__":
+    main()
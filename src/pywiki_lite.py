@@ -1,5 +1,10 @@
 #!/usr/bin/python
+import asyncio
+import bisect
 import collections
+import heapq
+import itertools
+import multiprocessing
 import os
 import ctypes
 import json
@@ -10,10 +15,18 @@ import time
 
 import configparser
 import random
+import re
+import signal
+import sqlite3
 import traceback
 
 import irc.bot
+import irc.client
+import irc.client_aio
+import irc.dict
+import aiohttp
 import requests
+import requests.adapters
 import argparse
 
 import openai
@@ -24,13 +37,28 @@ from tkinter import messagebox, ttk, font, IntVar
 import tkinter.scrolledtext as tkscrolled
 import tkinter as tk
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 import webbrowser
-# import websocket
+import websocket
 import gpt4all
 import io
-from contextlib import redirect_stdout
+from concurrent.futures import Future, CancelledError
+from contextlib import redirect_stdout, contextmanager, asynccontextmanager
 from html import escape
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+try:
+    # Exact token counts for OpenAI models, otherwise they are estimated
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Local GPT4All models, by the name shown in the model dropdown
+LOCAL_MODELS = {
+    'mpt-7b-chat': 'ggml-mpt-7b-chat.bin',
+    'WizardLM-13B': 'wizardlm-13b-v1.1-superhot-8k.ggmlv3.q4_0.bin',
+}
 
 
 def resource_path(relative_path):
@@ -47,7 +75,2268 @@ def get_version():
     return "1.66"  # Version Number
 
 
+class HttpResponse:
+    """The parts of a requests.Response the bot uses, for responses read with aiohttp."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HttpClient:
+    """Shared HTTP client for every Helix, IGDB, pronoun and launch request.
+
+    Connections are pooled and kept alive, every host has a timeout, 429 and 5xx responses are retried with
+    exponential backoff that honors Ratelimit-Reset and Retry-After, and a 401 on a user token request refreshes
+    the token once while any other thread that hit the same 401 waits for that refresh instead of starting its own.
+    aget/apost do the same with aiohttp for coroutines on the bot's event loop.
+    """
+
+    TIMEOUTS = {
+        'api.twitch.tv': 10,
+        'id.twitch.tv': 10,
+        'api.igdb.com': 10,
+        'pronouns.alejo.io': 5,
+        'api.openai.com': 60,
+        'll.thespacedevs.com': 10,
+    }
+    DEFAULT_TIMEOUT = 10
+    MAX_BACKOFF = 30
+
+    def __init__(self, refresh_token=None, get_token=None, max_retries=3):
+        self.refresh_token = refresh_token
+        self.get_token = get_token
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.refresh_lock = threading.Lock()
+        self.token_generation = 0
+
+        # aiohttp sessions belong to one event loop, the bot gets a new loop every run
+        self.async_session = None
+        self.async_loop = None
+
+        # endpoint -> [calls, errors, total seconds, max seconds], (endpoint, status or None) -> calls
+        self.stats = {}
+        self.statuses = {}
+        self.stats_lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, headers=None, refresh=False, endpoint=None, **kwargs):
+        host = urlsplit(url).hostname
+        if endpoint is None:
+            endpoint = host + urlsplit(url).path
+        kwargs.setdefault('timeout', self.TIMEOUTS.get(host, self.DEFAULT_TIMEOUT))
+        headers = dict(headers or {})
+
+        attempt = 0
+        refreshed = False
+        while True:
+            generation = self.token_generation
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except requests.RequestException:
+                self.record(endpoint, time.perf_counter() - start, None)
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.record(endpoint, time.perf_counter() - start, response.status_code)
+
+            if response.status_code == 401 and refresh and not refreshed and self.refresh_token is not None:
+                self.refresh(generation)
+                refreshed = True
+                if self.get_token is not None and 'Authorization' in headers:
+                    scheme = headers['Authorization'].split(' ', 1)[0]
+                    headers['Authorization'] = scheme + ' ' + self.get_token()
+                continue
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                time.sleep(self.backoff(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest('GET', url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest('POST', url, **kwargs)
+
+    async def arequest(self, method, url, headers=None, refresh=False, endpoint=None, **kwargs):
+        host = urlsplit(url).hostname
+        if endpoint is None:
+            endpoint = host + urlsplit(url).path
+        timeout = aiohttp.ClientTimeout(total=kwargs.pop('timeout', self.TIMEOUTS.get(host, self.DEFAULT_TIMEOUT)))
+        headers = dict(headers or {})
+        session = self.get_async_session()
+
+        attempt = 0
+        refreshed = False
+        while True:
+            generation = self.token_generation
+            start = time.perf_counter()
+            try:
+                async with session.request(method, url, headers=headers, timeout=timeout, **kwargs) as r:
+                    response = HttpResponse(r.status, r.headers, await r.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.record(endpoint, time.perf_counter() - start, None)
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.record(endpoint, time.perf_counter() - start, response.status_code)
+
+            if response.status_code == 401 and refresh and not refreshed and self.refresh_token is not None:
+                # The refresh is shared with the threads, run it off the loop
+                await asyncio.get_running_loop().run_in_executor(None, self.refresh, generation)
+                refreshed = True
+                if self.get_token is not None and 'Authorization' in headers:
+                    scheme = headers['Authorization'].split(' ', 1)[0]
+                    headers['Authorization'] = scheme + ' ' + self.get_token()
+                continue
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                await asyncio.sleep(self.backoff(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+    @asynccontextmanager
+    async def astream(self, method, url, headers=None, endpoint=None, **kwargs):
+        # For bodies read as they arrive, not retried. Leaving before the body is done closes the connection.
+        host = urlsplit(url).hostname
+        if endpoint is None:
+            endpoint = host + urlsplit(url).path
+        timeout = aiohttp.ClientTimeout(sock_read=kwargs.pop('timeout', self.TIMEOUTS.get(host, self.DEFAULT_TIMEOUT)))
+        start = time.perf_counter()
+        status = None
+        try:
+            async with self.get_async_session().request(method, url, headers=headers, timeout=timeout,
+                                                        **kwargs) as response:
+                status = response.status
+                yield response
+        finally:
+            self.record(endpoint, time.perf_counter() - start, status)
+
+    def get_async_session(self):
+        loop = asyncio.get_running_loop()
+        if self.async_session is None or self.async_loop is not loop:
+            self.async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, limit_per_host=32))
+            self.async_loop = loop
+        return self.async_session
+
+    async def aclose(self):
+        if self.async_session is not None and self.async_loop is asyncio.get_running_loop():
+            await self.async_session.close()
+        self.async_session = None
+        self.async_loop = None
+
+    def refresh(self, generation):
+        with self.refresh_lock:
+            # Someone else refreshed while we were waiting on the lock
+            if generation != self.token_generation:
+                return
+            try:
+                self.refresh_token()
+            finally:
+                self.token_generation += 1
+
+    def backoff(self, attempt, response=None):
+        delay = 2 ** attempt
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            reset = response.headers.get('Ratelimit-Reset')
+            try:
+                if retry_after is not None:
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+                    else:
+                        delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                elif reset is not None:
+                    delay = int(reset) - time.time()
+            except (TypeError, ValueError):
+                pass
+        return min(max(delay, 0.1), self.MAX_BACKOFF)
+
+    def record(self, endpoint, seconds, status):
+        # status is None when there was no response at all
+        with self.stats_lock:
+            stat = self.stats.setdefault(endpoint, [0, 0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += status is None or status >= 400
+            stat[2] += seconds
+            stat[3] = max(stat[3], seconds)
+            self.statuses[endpoint, status] = self.statuses.get((endpoint, status), 0) + 1
+
+    def latency_stats(self):
+        with self.stats_lock:
+            return {endpoint: {'calls': calls, 'errors': errors, 'avg': total / calls, 'max': longest}
+                    for endpoint, (calls, errors, total, longest) in self.stats.items()}
+
+    def status_counts(self):
+        with self.stats_lock:
+            return dict(self.statuses)
+
+
+class PersistentCache:
+    """SQLite cache for Helix users and pronouns that survives restarts.
+
+    Each kind of entry has its own TTL, and once the table grows past max_entries the least recently written
+    entries are evicted. The database is opened on first use. It is read and written on the bot's event loop, so it
+    runs in WAL mode without an fsync per commit, and writes are held in memory and committed together at most once
+    every COMMIT_INTERVAL seconds (and on close) instead of once per call.
+    """
+
+    TTLS = {
+        'user': 7 * 24 * 3600,
+        'pronouns': 24 * 3600,
+        'summary': 3600,
+    }
+    DEFAULT_TTL = 3600
+    COMMIT_INTERVAL = 1
+
+    def __init__(self, path='cache.db', max_entries=50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = None
+        self.lock = threading.Lock()
+        self.writes = 0
+        # (kind, key) -> (value as JSON, updated) written since the last commit
+        self.pending = {}
+        self.last_commit = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        # Caller must hold self.lock
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            # Shards share the file, WAL lets them read while one writes
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, value TEXT, '
+                                    'updated REAL, PRIMARY KEY (kind, key))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS cache_updated ON cache (updated)')
+            self.connection.execute('DELETE FROM cache WHERE updated < ?',
+                                    (time.time() - max(self.TTLS.values()),))
+            self.connection.commit()
+        return self.connection
+
+    def get(self, kind, key):
+        with self.lock:
+            row = self.pending.get((kind, key))
+            if row is None:
+                row = self.connect().execute('SELECT value, updated FROM cache WHERE kind = ? AND key = ?',
+                                             (kind, key)).fetchone()
+            if row is None or time.time() - row[1] > self.TTLS.get(kind, self.DEFAULT_TTL):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, kind, key, value):
+        self.set_many(kind, {key: value})
+
+    def set_many(self, kind, values):
+        with self.lock:
+            now = time.time()
+            for key, value in values.items():
+                self.pending[kind, key] = (json.dumps(value), now)
+            if time.monotonic() - self.last_commit >= self.COMMIT_INTERVAL:
+                self.commit()
+
+    def commit(self):
+        # Caller must hold self.lock
+        self.last_commit = time.monotonic()
+        if not self.pending:
+            return
+        connection = self.connect()
+        connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                               [(kind, key, value, updated) for (kind, key), (value, updated) in self.pending.items()])
+        self.writes += len(self.pending)
+        self.pending.clear()
+        if self.writes >= 1000:
+            self.writes = 0
+            connection.execute('DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY updated '
+                               'DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class UserPrefetcher:
+    """Warms the user and pronoun cache for chatters as soon as they are seen.
+
+    New logins are collected from NAMES, JOIN and chat, looked up on /helix/users 100 at a time (the most one
+    request accepts) and then have their pronouns fetched, up to max_concurrent at once, all on the bot's event loop.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, cache, fetch_users, fetch_pronouns, loop, delay=2, max_concurrent=10):
+        self.cache = cache
+        self.fetch_users = fetch_users
+        self.fetch_pronouns = fetch_pronouns
+        self.loop = loop
+        self.delay = delay
+
+        self.seen = set()
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.running = True
+
+    def add(self, logins):
+        # Called on the event loop
+        for login in logins:
+            login = login.lower()
+            if login and login not in self.seen:
+                self.seen.add(login)
+                self.pending.append(login)
+        if not self.pending or not self.running:
+            return
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            # Wait a little so joins arriving together end up in the same batch
+            self.flush_handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        while self.pending:
+            batch = self.pending[:self.BATCH_SIZE]
+            del self.pending[:self.BATCH_SIZE]
+            task = self.loop.create_task(self.prefetch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def prefetch(self, batch):
+        try:
+            missing = [login for login in batch if self.cache.get('user', login) is None]
+            if missing:
+                await self.fetch_users(missing)
+            await asyncio.gather(*[self.prefetch_pronouns(login) for login in batch
+                                   if self.cache.get('pronouns', login) is None])
+        except Exception as e:
+            print(str(e))
+            print(traceback.format_exc())
+
+    async def prefetch_pronouns(self, login):
+        async with self.semaphore:
+            if self.running:
+                await self.fetch_pronouns(login)
+
+    def stop(self):
+        self.running = False
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for task in list(self.tasks):
+            task.cancel()
+
+
+class Roster:
+    """Chatters in the channel keyed by lowercase login, with when they joined and when they last spoke.
+
+    This is the source of truth for who is in chat, the GUI user list only displays it.
+    """
+
+    def __init__(self):
+        # login -> [joined at, last seen]
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def add(self, login):
+        login = login.lower()
+        with self.lock:
+            if login in self.users:
+                return False
+            now = time.time()
+            self.users[login] = [now, now]
+            return True
+
+    def seen(self, login):
+        # Records activity, returns True if the chatter wasn't on the roster yet
+        login = login.lower()
+        with self.lock:
+            entry = self.users.get(login)
+            if entry is not None:
+                entry[1] = time.time()
+                return False
+            now = time.time()
+            self.users[login] = [now, now]
+            return True
+
+    def remove(self, login):
+        with self.lock:
+            return self.users.pop(login.lower(), None) is not None
+
+    def logins(self):
+        with self.lock:
+            return list(self.users)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+
+    def __contains__(self, login):
+        return login.lower() in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+
+class ModelPool:
+    """Keeps local GPT4All models loaded between replies.
+
+    Each model is loaded the first time it is needed (or when warmed) and kept until it has been idle for
+    idle_timeout seconds. Access to a model is serialized since llmodel is not safe to share between threads.
+    """
+
+    def __init__(self, idle_timeout=600, log_callback=None):
+        self.idle_timeout = idle_timeout
+        self.log_callback = log_callback
+        self.models = {}
+        self.model_locks = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+        self.reaper_thread = threading.Thread(target=self.reap_idle_models)
+        self.reaper_thread.daemon = True
+        self.reaper_thread.start()
+
+    def log(self, message):
+        print(message)
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def get_lock(self, name):
+        with self.lock:
+            if name not in self.model_locks:
+                self.model_locks[name] = threading.Lock()
+            return self.model_locks[name]
+
+    def load(self, name):
+        # Caller must hold the model lock
+        if name in self.models:
+            return self.models[name], ''
+        with io.StringIO() as buffer, redirect_stdout(buffer):
+            model = gpt4all.GPT4All(model_name=LOCAL_MODELS[name],
+                                    model_path=os.path.abspath('.'),
+                                    allow_download=False)
+            output = buffer.getvalue().strip()
+        self.models[name] = model
+        self.last_used[name] = time.monotonic()
+        return model, output
+
+    @contextmanager
+    def acquire(self, name):
+        with self.get_lock(name):
+            model, output = self.load(name)
+            if output:
+                self.log(output)
+            try:
+                yield model
+            finally:
+                self.last_used[name] = time.monotonic()
+
+    def warm(self, name):
+        if name not in LOCAL_MODELS:
+            return
+
+        def load_model():
+            try:
+                with self.acquire(name):
+                    self.log('Loaded ' + name)
+            except Exception as e:
+                self.log('Error loading ' + name + ': ' + str(e))
+
+        thread = threading.Thread(target=load_model)
+        thread.daemon = True
+        thread.start()
+
+    def unload(self, name):
+        with self.get_lock(name):
+            if self.models.pop(name, None) is not None:
+                self.last_used.pop(name, None)
+                self.log('Unloaded ' + name)
+
+    def reap_idle_models(self):
+        while True:
+            time.sleep(30)
+            if self.idle_timeout <= 0:
+                continue
+            now = time.monotonic()
+            for name, last_used in list(self.last_used.items()):
+                if now - last_used < self.idle_timeout:
+                    continue
+                # Skip models that are generating right now, they will be checked again next pass
+                model_lock = self.get_lock(name)
+                if model_lock.acquire(blocking=False):
+                    try:
+                        if self.models.pop(name, None) is not None:
+                            self.last_used.pop(name, None)
+                            self.log('Unloaded idle model ' + name)
+                    finally:
+                        model_lock.release()
+
+    def close(self):
+        for name in list(self.models):
+            self.unload(name)
+
+
+class InferenceBusy(Exception):
+    pass
+
+
+class CompletionError(Exception):
+    # A streamed completion OpenAI answered with an error status, shaped like openai's errors for the retry backoff
+    def __init__(self, http_status, headers, text):
+        super().__init__('OpenAI returned ' + str(http_status) + ': ' + text)
+        self.http_status = http_status
+        self.headers = headers
+
+
+def chat_header(messages):
+    # The context, summary and chat history of a job folded into one system prompt
+    lines = []
+    for message in messages or []:
+        name = message.get('name') or ('You' if message.get('role') == 'assistant' else '')
+        lines.append(name + ': ' + message['content'] if name else message['content'])
+    return '\n'.join(lines)
+
+
+def inference_worker(request_queue, response_queue, cancel_generation, idle_timeout):
+    # Runs in the inference subprocess, owns the loaded models
+    model_pool = ModelPool(idle_timeout, lambda message: response_queue.put((None, 'log', message)))
+
+    while True:
+        job = request_queue.get()
+        if job is None:
+            break
+        job_id, generation, model_name, messages, prompt = job
+
+        def cancelled():
+            return generation < cancel_generation.value
+
+        if cancelled():
+            response_queue.put((job_id, 'cancelled', None))
+            continue
+        try:
+            with model_pool.acquire(model_name) as model:
+                if prompt is None:
+                    # Warm up request, loading the model is all that was asked for
+                    response_queue.put((job_id, 'ok', ''))
+                    continue
+                # gpt4all only starts from a clean context when the session holds nothing but the system prompt
+                with model.chat_session(system_prompt=chat_header(messages)):
+                    # Returning False from the callback stops decoding
+                    response = model.generate(prompt, max_tokens=500, temp=0.7,
+                                              callback=lambda token_id, text: not cancelled())
+            if cancelled():
+                response_queue.put((job_id, 'cancelled', None))
+            else:
+                response_queue.put((job_id, 'ok', response))
+        except Exception:
+            response_queue.put((job_id, 'error', traceback.format_exc()))
+
+    model_pool.close()
+
+
+class InferenceServer:
+    """Runs local model inference in a separate process so decoding never holds up the bot or the GUI.
+
+    Jobs are submitted from any thread and answered through futures. Submitting while max_pending jobs are
+    already queued or running raises InferenceBusy instead of piling up more work.
+    """
+
+    def __init__(self, idle_timeout=600, max_pending=2, log_callback=None):
+        self.idle_timeout = idle_timeout
+        self.max_pending = max_pending
+        self.log_callback = log_callback
+        self.context = multiprocessing.get_context('spawn')
+        self.pending = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.process = None
+
+    def log(self, message):
+        print(message)
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def ensure_running(self):
+        # Caller must hold self.lock
+        if self.process is not None and self.process.is_alive():
+            return
+        self.request_queue = self.context.Queue()
+        self.response_queue = self.context.Queue()
+        self.cancel_generation = self.context.Value('i', 0)
+        self.process = self.context.Process(target=inference_worker,
+                                            args=(self.request_queue, self.response_queue,
+                                                  self.cancel_generation, self.idle_timeout))
+        self.process.daemon = True
+        self.process.start()
+
+        listener = threading.Thread(target=self.process_responses, args=(self.process, self.response_queue))
+        listener.daemon = True
+        listener.start()
+
+    def submit(self, model_name, messages=None, prompt=None):
+        future = Future()
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                raise InferenceBusy(model_name + ' is busy with ' + str(len(self.pending)) + ' pending replies')
+            self.ensure_running()
+            job_id = next(self.job_ids)
+            self.pending[job_id] = future
+            self.request_queue.put((job_id, self.cancel_generation.value, model_name, messages, prompt))
+        return future
+
+    def generate(self, model_name, messages, prompt, timeout=300):
+        return self.submit(model_name, messages, prompt).result(timeout)
+
+    def idle(self):
+        with self.lock:
+            return not self.pending
+
+    async def agenerate(self, model_name, messages, prompt, timeout=300):
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(model_name, messages, prompt)), timeout)
+
+    def warm(self, model_name):
+        if model_name not in LOCAL_MODELS:
+            return
+        try:
+            self.submit(model_name)
+        except InferenceBusy:
+            pass
+
+    def cancel_all(self):
+        with self.lock:
+            if self.process is not None:
+                with self.cancel_generation.get_lock():
+                    self.cancel_generation.value += 1
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.cancel()
+
+    def process_responses(self, process, response_queue):
+        while True:
+            try:
+                job_id, status, result = response_queue.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # The worker died, fail everything it was holding
+                with self.lock:
+                    if self.process is process:
+                        pending = list(self.pending.values())
+                        self.pending.clear()
+                    else:
+                        pending = []
+                for future in pending:
+                    future.set_exception(RuntimeError('Inference process exited'))
+                return
+
+            if status == 'log':
+                self.log(result)
+                continue
+            with self.lock:
+                future = self.pending.pop(job_id, None)
+            if future is None or future.done():
+                continue
+            if status == 'ok':
+                future.set_result(result)
+            elif status == 'cancelled':
+                future.cancel()
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def close(self):
+        self.cancel_all()
+        with self.lock:
+            process = self.process
+            self.process = None
+            if process is None:
+                return
+            self.request_queue.put(None)
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+
+def format_duration(seconds):
+    return format(seconds * 1000, '.0f') + ' ms' if seconds < 1 else format(seconds, '.2f') + ' s'
+
+
+class LatencyStats:
+    """Rolling latency histograms for each stage of building and sending a reply.
+
+    span() times a stage from any thread or coroutine. Each stage keeps its last `window` durations and the
+    percentiles are worked out when the stats are read, so recording stays cheap. Every duration is also counted
+    into fixed buckets for the metrics endpoint, those are never reset.
+    """
+
+    # Upper bounds in seconds of the histogram buckets, a last one catches everything slower
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        # stage -> [count per bucket, total seconds]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = collections.deque(maxlen=self.window)
+                self.counts[stage] = 0
+            samples.append(seconds)
+            self.counts[stage] += 1
+            buckets = self.buckets.get(stage)
+            if buckets is None:
+                buckets = self.buckets[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            buckets[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            buckets[1] += seconds
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        # [stage, calls, p50, p95, max] for every stage, slowest p95 first
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+            counts = dict(self.counts)
+        rows = [[stage, counts[stage], values[len(values) // 2], values[min(len(values) - 1, len(values) * 95 // 100)],
+                 values[-1]] for stage, values in samples.items()]
+        return sorted(rows, key=lambda row: -row[3])
+
+    def report(self):
+        # A table for the GUI stats pane
+        rows = self.summary()
+        if not rows:
+            return 'No replies yet'
+        width = max(len(row[0]) for row in rows)
+        lines = ['stage'.ljust(width) + '   calls       p50       p95       max']
+        for stage, calls, p50, p95, most in rows:
+            lines.append(stage.ljust(width) + str(calls).rjust(8) + ''.join(
+                format_duration(value).rjust(10) for value in (p50, p95, most)))
+        return '\n'.join(lines)
+
+    def line(self, limit=450):
+        # The slowest stages on one line for chat
+        parts = []
+        for stage, calls, p50, p95, most in self.summary():
+            part = stage + ' ' + format_duration(p50) + '/' + format_duration(p95)
+            if len(' | '.join(parts + [part])) > limit:
+                break
+            parts.append(part)
+        return 'p50/p95: ' + ' | '.join(parts) if parts else 'No replies yet'
+
+    def histograms(self):
+        # stage -> (cumulative count per bucket, total seconds)
+        with self.lock:
+            return {stage: (list(itertools.accumulate(counts)), total)
+                    for stage, (counts, total) in self.buckets.items()}
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+
+class Metrics:
+    """Labelled counters for the metrics endpoint, bumped from any thread or coroutine.
+
+    BotCore keeps them, so they carry on across bot runs. Each set of labels is its own series.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.counters.get(name, {}))
+
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                          + '"' for key, value in labels) + '}'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.collect().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # A line per scrape would bury the chat
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves the bot's metrics at /metrics in the Prometheus text format, on a thread of its own.
+
+    Counters come from BotCore.metrics, the HTTP client and the cache. Queue depths and job counts are read from
+    the running bot on every scrape, they start over with each bot run, which Prometheus takes as a counter reset.
+    Reply latency is exported as a histogram per stage.
+    """
+
+    daemon_threads = True
+
+    # name -> (type, help) of the counters kept in BotCore.metrics
+    COUNTERS = {
+        'pywiki_messages_received_total': ('counter', 'Chat messages received'),
+        'pywiki_replies_total': ('counter', 'Replies generated'),
+        'pywiki_reply_failures_total': ('counter', 'Replies given up on, by reason'),
+        'pywiki_summaries_total': ('counter', 'Chat summaries generated'),
+        'pywiki_tokens_total': ('counter', 'OpenAI tokens used, estimated for streamed replies'),
+    }
+
+    def __init__(self, core, host='127.0.0.1', port=9464):
+        super().__init__((host, port), MetricsHandler)
+        self.core = core
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def collect(self):
+        core = self.core
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels, value in samples:
+                lines.append(name + metric_labels(labels) + ' ' + str(value))
+
+        family('pywiki_bot_running', 'gauge', 'Whether the bot is started', [((), int(core.running))])
+        for name, (kind, help_text) in self.COUNTERS.items():
+            family(name, kind, help_text, core.metrics.get(name).items())
+
+        statuses = core.http.status_counts()
+        family('pywiki_http_requests_total', 'counter', 'HTTP requests by endpoint and status, error for no response',
+               [((('endpoint', endpoint), ('status', str(status) if status is not None else 'error')), calls)
+                for (endpoint, status), calls in sorted(statuses.items(), key=str)])
+        family('pywiki_http_request_seconds_total', 'counter', 'Seconds spent on HTTP requests by endpoint',
+               [((('endpoint', endpoint),), stat['avg'] * stat['calls'])
+                for endpoint, stat in sorted(core.http.latency_stats().items())])
+
+        family('pywiki_cache_hits_total', 'counter', 'User, pronoun and summary cache hits', [((), core.cache.hits)])
+        family('pywiki_cache_misses_total', 'counter', 'User, pronoun and summary cache misses',
+               [((), core.cache.misses)])
+        family('pywiki_journal_queue_depth', 'gauge', 'Chat lines waiting to be journaled',
+               [((), core.journal.queue.qsize())])
+
+        bot = core.bot
+        if bot is not None:
+            replies = bot.scheduler.stats()
+            family('pywiki_reply_queue_depth', 'gauge', 'Replies waiting for a worker', [((), replies['depth'])])
+            family('pywiki_reply_jobs_total', 'counter', 'Reply jobs by what became of them, this bot run',
+                   [((('outcome', outcome),), replies[outcome])
+                    for outcome in ('queued', 'coalesced', 'dropped', 'served')])
+            sent = bot.send_queue.stats()
+            family('pywiki_send_queue_depth', 'gauge', 'Chat messages waiting for the rate limit',
+                   [((), sent['depth'])])
+            family('pywiki_send_queue_messages_total', 'counter', 'Chat messages by what became of them, this bot run',
+                   [((('outcome', outcome),), sent[outcome]) for outcome in ('sent', 'throttled', 'dropped')])
+
+        name = 'pywiki_reply_stage_seconds'
+        lines.append('# HELP ' + name + ' Time spent in each stage of building and sending a reply')
+        lines.append('# TYPE ' + name + ' histogram')
+        bounds = [str(bound) for bound in LatencyStats.BUCKETS] + ['+Inf']
+        for stage, (counts, total) in sorted(core.latency.histograms().items()):
+            for bound, count in zip(bounds, counts):
+                lines.append(name + '_bucket' + metric_labels((('stage', stage), ('le', bound))) + ' ' + str(count))
+            lines.append(name + '_sum' + metric_labels((('stage', stage),)) + ' ' + str(total))
+            lines.append(name + '_count' + metric_labels((('stage', stage),)) + ' ' + str(counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread for a while and writes them as collapsed stacks next to config.ini.
+
+    Runs on a thread of its own, so it can be started on a live bot. Each sample walks sys._current_frames(), there is
+    no tracing in between. The file has a `thread;outermost;...;innermost count` line per distinct stack, which
+    flamegraph.pl and speedscope read.
+    """
+
+    INTERVAL = 0.005
+    # Logged with their share of the samples when a profile is written
+    WATCHED = ('TwitchBot.on_pubmsg', 'TwitchBot.generate_response', 'HttpClient.')
+
+    def __init__(self, directory, log_callback=None):
+        self.directory = directory
+        self.log_callback = log_callback
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def log(self, message):
+        print(message)
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def start(self, seconds):
+        # Returns the file the profile will be written to, or None while one is already running
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return None
+            path = os.path.join(self.directory, 'profile-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.folded')
+            self.thread = threading.Thread(target=self.run, args=(seconds, path), name='profiler', daemon=True)
+            self.thread.start()
+        return path
+
+    def run(self, seconds, path):
+        own = threading.get_ident()
+        labels = {}
+        stacks = collections.Counter()
+        samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (getattr(code, 'co_qualname', code.co_name) + ' ('
+                                                + os.path.basename(code.co_filename) + ')')
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.INTERVAL)
+
+        try:
+            with open(path, 'w') as file:
+                for stack, count in stacks.most_common():
+                    file.write(stack + ' ' + str(count) + '\n')
+        except OSError as e:
+            self.log('Could not write the profile: ' + str(e))
+            return
+        shares = []
+        for name in self.WATCHED:
+            count = sum(count for stack, count in stacks.items() if ';' + name in stack)
+            shares.append(name.rstrip('.') + ' ' + format(count * 100 / max(samples, 1), '.0f') + '%')
+        self.log('Profile of ' + str(samples) + ' samples written to ' + path + ' (' + ', '.join(shares) + ')')
+
+
+class ResponseScheduler:
+    """Generates replies with a fixed number of worker tasks on the bot's event loop.
+
+    Jobs wait in a bounded priority queue, direct mentions first. A new job with the same key (a chatter in a
+    channel) as one already waiting replaces it, and jobs that have waited longer than max_age seconds are dropped.
+    When the queue is full the oldest job of the lowest priority gives way, unless the new job's priority is lower
+    still. The handler is a coroutine function and submit() is called on the loop.
+    """
+
+    MENTION = 0
+    DIRECT = 1
+    RANDOM = 2
+
+    def __init__(self, handler, loop, workers=2, max_queued=20, max_age=30, latency=None):
+        self.handler = handler
+        self.max_queued = max_queued
+        self.max_age = max_age
+        self.latency = latency
+
+        self.heap = []
+        self.by_key = {}
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.running = True
+
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.served = 0
+
+        self.workers = [loop.create_task(self.run_worker()) for _ in range(workers)]
+
+    def submit(self, priority, key, *args):
+        if not self.running:
+            return False
+
+        existing = self.by_key.get(key)
+        if existing is not None:
+            # Only answer the latest message from someone, at the best priority they asked with
+            existing[5] = False
+            priority = min(priority, existing[0])
+            del self.by_key[key]
+            self.coalesced += 1
+        elif len(self.by_key) >= self.max_queued:
+            worst = max(self.by_key.values(), key=lambda j: (j[0], -j[1]))
+            if worst[0] < priority:
+                self.dropped += 1
+                return False
+            worst[5] = False
+            del self.by_key[worst[3]]
+            self.dropped += 1
+
+        # [priority, sequence, queued at, key, handler arguments, valid]
+        job = [priority, next(self.sequence), time.monotonic(), key, args, True]
+        heapq.heappush(self.heap, job)
+        self.by_key[key] = job
+        # Replaced and evicted jobs stay in the heap until popped, clear them out once they are the majority
+        if len(self.heap) > 2 * len(self.by_key):
+            self.heap = [entry for entry in self.heap if entry[5]]
+            heapq.heapify(self.heap)
+        self.queued += 1
+        self.wakeup.set()
+        return True
+
+    async def run_worker(self):
+        while self.running:
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            job = heapq.heappop(self.heap)
+            if not job[5]:
+                continue
+            del self.by_key[job[3]]
+            waited = time.monotonic() - job[2]
+            if waited > self.max_age:
+                self.dropped += 1
+                continue
+            if self.latency is not None:
+                self.latency.record('queued', waited)
+
+            try:
+                if self.latency is not None:
+                    with self.latency.span('reply'):
+                        await self.handler(*job[4])
+                else:
+                    await self.handler(*job[4])
+            except Exception as e:
+                print(str(e))
+                print(traceback.format_exc())
+            self.served += 1
+
+    def depth(self):
+        return len(self.by_key)
+
+    def stats(self):
+        return {'queued': self.queued, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                'served': self.served, 'depth': len(self.by_key)}
+
+    def stop(self):
+        self.running = False
+        self.heap.clear()
+        self.by_key.clear()
+        for worker in self.workers:
+            worker.cancel()
+
+
+class RateBudget:
+    """Token bucket kept in shared memory, so shard processes can draw from one per-account Twitch budget.
+
+    acquire() takes a token and returns 0, or returns how many seconds to wait before one is available. A caller can
+    pass a higher limit, e.g. for channels where the bot is a moderator.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        # [tokens, last refill]
+        self.state = multiprocessing.get_context('spawn').Array('d', [limit, time.monotonic()])
+
+    def acquire(self, limit=None):
+        limit = limit or self.limit
+        with self.state.get_lock():
+            now = time.monotonic()
+            tokens = min(limit, self.state[0] + (now - self.state[1]) * limit / self.window)
+            self.state[1] = now
+            if tokens < 1:
+                self.state[0] = tokens
+                return (1 - tokens) * self.window / limit
+            self.state[0] = tokens - 1
+            return 0
+
+
+class SendQueue:
+    """Sends chat messages from one task on the bot's event loop, within Twitch's chat rate limit.
+
+    A token bucket allows 20 messages per 30 seconds, or 100 for messages to channels where the bot is a moderator
+    or the broadcaster. Messages over the limit wait in the queue, and ones that waited longer than max_latency
+    seconds are dropped. Shards of one bot account pass the same budget.
+    """
+
+    USER_LIMIT = 20
+    MODERATOR_LIMIT = 100
+    WINDOW = 30
+
+    def __init__(self, send, loop, max_latency=10, max_queued=50, budget=None, latency=None):
+        self.send = send
+        self.max_latency = max_latency
+        self.max_queued = max_queued
+        self.latency = latency
+
+        self.moderated_channels = set()
+        self.budget = budget if budget is not None else RateBudget(self.USER_LIMIT, self.WINDOW)
+
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.running = True
+
+        self.sent = 0
+        self.throttled = 0
+        self.dropped = 0
+
+        self.sender_task = loop.create_task(self.run_sender())
+
+    def limit(self, channel=None):
+        return self.MODERATOR_LIMIT if channel in self.moderated_channels else self.USER_LIMIT
+
+    def set_moderator(self, channel, moderator):
+        if moderator:
+            self.moderated_channels.add(channel)
+        else:
+            self.moderated_channels.discard(channel)
+        self.wakeup.set()
+
+    def put(self, channel, message, remember=True):
+        if not self.running or len(self.queue) >= self.max_queued:
+            self.dropped += 1
+            return False
+        # [queued at, channel, message, remember, throttled]
+        self.queue.append([time.monotonic(), channel, message, remember, False])
+        self.wakeup.set()
+        return True
+
+    async def run_sender(self):
+        while self.running:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            item = self.queue[0]
+            if time.monotonic() - item[0] > self.max_latency:
+                self.queue.popleft()
+                self.dropped += 1
+                continue
+
+            wait = self.budget.acquire(self.limit(item[1]))
+            if wait:
+                item[4] = True
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.queue.popleft()
+            self.sent += 1
+            if item[4]:
+                self.throttled += 1
+            if self.latency is not None:
+                self.latency.record('send wait', time.monotonic() - item[0])
+            try:
+                self.send(item[1], item[2], item[3])
+            except Exception as e:
+                print(str(e))
+                print(traceback.format_exc())
+
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {'sent': self.sent, 'throttled': self.throttled, 'dropped': self.dropped,
+                'depth': len(self.queue), 'moderated_channels': len(self.moderated_channels)}
+
+    def stop(self):
+        self.running = False
+        self.queue.clear()
+        self.sender_task.cancel()
+
+
+class ChannelInfoCache:
+    """Holds the Helix info of every joined channel so building a reply never waits on the network for it.
+
+    A background thread refetches channels whose info is older than ttl seconds, up to 100 per request, and
+    update() lets EventSub channel.update notifications replace it as soon as a streamer changes game or title.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, fetch, channel_ids, ttl=300):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.info = {}
+        self.updated_at = {channel_id: 0 for channel_id in channel_ids}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = True
+
+        self.refresh(list(self.updated_at))
+        self.refresh_thread = threading.Thread(target=self.run_refresh)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def refresh(self, channel_ids):
+        for start in range(0, len(channel_ids), self.BATCH_SIZE):
+            infos = self.fetch(channel_ids[start:start + self.BATCH_SIZE])
+            if not isinstance(infos, dict):
+                print('Channel info refresh failed: ' + str(infos))
+                continue
+            for channel_id, info in infos.items():
+                self.update(channel_id, info)
+
+    def update(self, channel_id, info):
+        with self.lock:
+            self.info[channel_id] = dict(self.info.get(channel_id, {}), **info)
+            self.updated_at[channel_id] = time.monotonic()
+
+    def get(self, channel_id, key, default='unknown'):
+        with self.lock:
+            value = self.info.get(channel_id, {}).get(key)
+            stale = time.monotonic() - self.updated_at.get(channel_id, 0) > self.ttl
+        if stale:
+            self.wake.set()
+        return value if value else default
+
+    def add(self, channel_ids):
+        # New channels are fetched by the refresh thread
+        with self.lock:
+            for channel_id in channel_ids:
+                self.updated_at.setdefault(channel_id, 0)
+        self.wake.set()
+
+    def __contains__(self, channel_id):
+        return channel_id in self.updated_at
+
+    def run_refresh(self):
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                stale = [channel_id for channel_id, updated_at in self.updated_at.items()
+                         if now - updated_at > self.ttl]
+                wait = min(self.updated_at.values(), default=now) + self.ttl - now
+            if not stale:
+                self.wake.wait(max(wait, 1))
+                self.wake.clear()
+                continue
+            if not self.running:
+                return
+            try:
+                self.refresh(stale)
+            except Exception as e:
+                print(str(e))
+            with self.lock:
+                failed = [channel_id for channel_id in stale if now - self.updated_at[channel_id] > self.ttl]
+            if failed:
+                # Don't hammer Helix while it is failing
+                self.wake.wait(min(self.ttl, 30))
+                self.wake.clear()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+
+class ChatMessage:
+    """One chat line with its chat completion message, built once when it arrives."""
+
+    __slots__ = ('author', 'login', 'text', 'timestamp', 'role', 'message_id', 'completion')
+
+    def __init__(self, author, text, role='user', timestamp=None, message_id=None, login=None):
+        # author is the display name, which can differ from the login in more than case
+        self.author = author
+        self.login = (login or author).lower()
+        self.text = text
+        self.role = role
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.message_id = message_id
+        if role == 'assistant':
+            self.completion = {"role": "assistant", "content": text}
+        else:
+            self.completion = {"role": "system", "name": author, "content": text}
+
+    def record(self):
+        return {'author': self.author, 'login': self.login, 'text': self.text, 'timestamp': self.timestamp,
+                'role': self.role, 'id': self.message_id}
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['author'], record['text'], record['role'], record['timestamp'], record.get('id'),
+                   record.get('login'))
+
+
+class ChatHistory:
+    """The last few chat lines in a channel, oldest first.
+
+    Lines pushed out of the window are kept in `scrolled` until the summarizer has folded them into the summary.
+    """
+
+    def __init__(self, size=10, scrolled_size=200):
+        self.entries = collections.deque(maxlen=size)
+        self.scrolled = collections.deque(maxlen=scrolled_size)
+
+    def add(self, author, text, role='user', timestamp=None, message_id=None, login=None):
+        entry = ChatMessage(author, text, role, timestamp, message_id, login)
+        if len(self.entries) == self.entries.maxlen:
+            self.scrolled.append(self.entries[0])
+        self.entries.append(entry)
+        return entry
+
+    def completion(self, skip_author=None, skip_text=None):
+        # The history as chat completion messages, leaving out the message being replied to. Replies are asked for
+        # with the display name from chat or the login from the GUI's user list, either matches the entry's login.
+        skip = (skip_author or '').lower()
+        return [entry.completion for entry in self.entries
+                if entry.role == 'assistant' or skip not in (entry.login, entry.author.lower())
+                or entry.text != skip_text]
+
+    def speakers(self):
+        # Chatters in the order they first spoke, without the bot
+        speakers = []
+        for entry in self.entries:
+            if entry.role != 'assistant' and entry.author not in speakers:
+                speakers.append(entry.author)
+        return speakers
+
+    def replay(self, entries):
+        # Puts journaled lines from before a restart ahead of anything said since
+        newer = list(self.entries)
+        self.entries.clear()
+        self.entries.extend(entries)
+        self.entries.extend(newer)
+
+    def clear(self):
+        self.entries.clear()
+        self.scrolled.clear()
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ChatJournal:
+    """Append-only chat log per channel, one JSON line per message, so the chat history survives restarts.
+
+    Lines are queued and written by a background thread. Once a channel's file passes max_bytes it is rotated to
+    <channel>.1.jsonl and so on, keeping the last `backups` files.
+    """
+
+    # Enough of the end of a file to find the last history window in
+    TAIL_BYTES = 64 * 1024
+
+    def __init__(self, directory, max_bytes=1024 * 1024, backups=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def path(self, channel, index=0):
+        name = channel.lstrip('#').lower()
+        return os.path.join(self.directory, name + ('.' + str(index) if index else '') + '.jsonl')
+
+    def append(self, channel, entry):
+        # Never blocks on disk, the writer thread is started on first use
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_entries)
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((channel, entry.record()))
+
+    def write_entries(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = set()
+            for item in batch:
+                if item is None:
+                    continue
+                channel, record = item
+                try:
+                    file = self.files.get(channel)
+                    if file is None:
+                        file = self.files[channel] = open(self.path(channel), 'a', encoding='utf-8')
+                    file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    written.add(channel)
+                except OSError as e:
+                    print('Could not write the chat journal for ' + channel + ': ' + str(e))
+            for channel in written:
+                try:
+                    file = self.files[channel]
+                    file.flush()
+                    if file.tell() >= self.max_bytes:
+                        self.rotate(channel)
+                except OSError as e:
+                    print('Could not write the chat journal for ' + channel + ': ' + str(e))
+            for _ in batch:
+                self.queue.task_done()
+            if None in batch:
+                break
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+    def rotate(self, channel):
+        self.files.pop(channel).close()
+        for index in range(self.backups, 0, -1):
+            if os.path.exists(self.path(channel, index - 1)):
+                os.replace(self.path(channel, index - 1), self.path(channel, index))
+
+    def recent(self, channel, count, max_age=None):
+        # The last count entries, newest last, read back from the current file and the rotated ones if needed
+        self.flush()
+        records = []
+        for index in range(self.backups + 1):
+            records = self.read_tail(self.path(channel, index)) + records
+            if len(records) >= count:
+                break
+        entries = [ChatMessage.from_record(record) for record in records[-count:]]
+        if max_age is not None:
+            entries = [entry for entry in entries if time.time() - entry.timestamp <= max_age]
+        return entries
+
+    def read_tail(self, path):
+        try:
+            with open(path, 'rb') as file:
+                file.seek(0, os.SEEK_END)
+                start = max(0, file.tell() - self.TAIL_BYTES)
+                file.seek(start)
+                lines = file.read().split(b'\n')
+        except OSError:
+            return []
+        if start > 0:
+            # The first line was cut by the seek
+            lines = lines[1:]
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Blank or cut off by a crash mid write
+                continue
+            if isinstance(record, dict) and {'author', 'text', 'timestamp', 'role'} <= record.keys():
+                records.append(record)
+        return records
+
+    def flush(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join(5)
+            self.thread = None
+
+
+class ChatSummarizer:
+    """Folds chat that has scrolled out of a channel's history window into its running summary.
+
+    Runs on the bot's event loop next to replies, never in them. A channel is summarized once min_lines have
+    scrolled out, at most once every `interval` seconds, and only one summary is generated at a time.
+    """
+
+    def __init__(self, summarize, loop, interval=300, min_lines=10):
+        self.summarize = summarize
+        self.loop = loop
+        self.interval = interval
+        self.min_lines = min_lines
+
+        self.last_run = {}
+        # Channel name -> the timer or task summarizing it
+        self.pending = {}
+        self.tasks = set()
+        self.lock = asyncio.Lock()
+        self.running = True
+
+    def check(self, channel):
+        # Called on the event loop whenever the channel's history has grown
+        if (not self.running or self.interval <= 0 or channel.name in self.pending
+                or len(channel.history.scrolled) < self.min_lines):
+            return
+        wait = self.last_run.get(channel.name, -self.interval) + self.interval - time.monotonic()
+        if wait > 0:
+            self.pending[channel.name] = self.loop.call_later(wait, self.start, channel)
+        else:
+            self.start(channel)
+
+    def start(self, channel):
+        task = self.loop.create_task(self.run(channel))
+        self.pending[channel.name] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, channel):
+        try:
+            async with self.lock:
+                if not self.running:
+                    return
+                self.last_run[channel.name] = time.monotonic()
+                lines = list(channel.history.scrolled)
+                summary = await self.summarize(channel.name, channel.summary, lines)
+                if summary:
+                    channel.summary = summary
+                    # Only drop what went into the summary, more may have scrolled out meanwhile
+                    summarized = set(map(id, lines))
+                    while channel.history.scrolled and id(channel.history.scrolled[0]) in summarized:
+                        channel.history.scrolled.popleft()
+        except Exception as e:
+            print('Summarizing ' + channel.name + ' failed: ' + str(e))
+        finally:
+            self.pending.pop(channel.name, None)
+
+    def stop(self):
+        self.running = False
+        for pending in list(self.pending.values()):
+            pending.cancel()
+        self.pending.clear()
+
+
+class ChannelState:
+    """One joined channel: its id, chatters, recent chat and compiled context."""
+
+    def __init__(self, name, channel_id):
+        self.name = name
+        self.channel_id = channel_id
+        self.roster = Roster()
+        self.history = ChatHistory()
+        # What happened before the history window, kept short by ChatSummarizer
+        self.summary = ''
+        self.last_message = {}
+        self.prompt_template = PromptTemplate('')
+
+
+class PromptTemplate:
+    """The context text split once into literal text and the <tags> it uses, so rendering is a single join."""
+
+    TAG_PATTERN = re.compile(r'<(name|channel|game|author|emotes|UTC|time|chatter_pronouns|streamer_pronouns|users)>')
+
+    def __init__(self, text):
+        self.text = text
+        # Even entries are literal text, odd entries are tag names
+        self.parts = self.TAG_PATTERN.split(text)
+        self.tags = set(self.parts[1::2])
+
+    def render(self, values):
+        return ''.join(part if index % 2 == 0 else values[part] for index, part in enumerate(self.parts))
+
+
+class PromptBuilder:
+    """Builds the messages for a reply within a token budget and reports what each section of the prompt costs.
+
+    The sections are the context, the <emotes> and <users> lists inside it, the summary of earlier chat, the chat
+    history and the chatter's message. While the prompt is over budget it gives up, in order: the full emote list for
+    a sample of it, the full user list for a count and the recent speakers, the oldest history and the summary.
+    """
+
+    # Prompt tokens per model, well inside each context window so the reply has room
+    BUDGETS = {
+        'gpt-4': 2000,
+        'gpt-4-0613': 2000,
+        'gpt-3.5-turbo': 2000,
+        'mpt-7b-chat': 1200,
+        'WizardLM-13B': 2000,
+    }
+    DEFAULT_BUDGET = 2000
+    EMOTE_SAMPLE = 25
+    RECENT_SPEAKERS = 10
+    # What a chat message costs on top of its content
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, model):
+        self.model = model
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding('cl100k_base')
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        # About four characters per token in English
+        return (len(text) + 3) // 4
+
+    def budget(self, override=0):
+        return override or self.BUDGETS.get(self.model, self.DEFAULT_BUDGET)
+
+    def build(self, template, values, emotes, users, speakers, history, message, budget, summary=''):
+        # Returns the context and history messages and the tokens spent per section
+        values = dict(values)
+        if 'emotes' in template.tags:
+            values['emotes'] = ', '.join(emotes)
+        if 'users' in template.tags:
+            values['users'] = users if isinstance(users, str) else ', '.join(users)
+        history_tokens = [self.count(entry['content']) + self.MESSAGE_OVERHEAD for entry in history]
+        summary = [{"role": "system", "content": "Earlier in chat: " + summary}] if summary else []
+        message_tokens = self.count(message) + self.MESSAGE_OVERHEAD
+        degraded = []
+
+        while True:
+            sentences = template.render(values).split('. ')
+            context_tokens = sum(self.count(sentence) + self.MESSAGE_OVERHEAD for sentence in sentences)
+            sections = {
+                'emotes': self.count(values['emotes']) if 'emotes' in values else 0,
+                'users': self.count(values['users']) if 'users' in values else 0,
+            }
+            sections['context'] = context_tokens - sections['emotes'] - sections['users']
+            sections['summary'] = sum(self.count(entry['content']) + self.MESSAGE_OVERHEAD for entry in summary)
+            sections['history'] = sum(history_tokens)
+            sections['message'] = message_tokens
+            over = sum(sections.values()) - budget
+            if over <= 0:
+                break
+
+            if sections['emotes'] and 'emotes' not in degraded and len(emotes) > self.EMOTE_SAMPLE:
+                values['emotes'] = ', '.join(random.sample(emotes, self.EMOTE_SAMPLE))
+                degraded.append('emotes')
+            elif sections['users'] and 'users' not in degraded and not isinstance(users, str):
+                recent = speakers[-self.RECENT_SPEAKERS:]
+                values['users'] = str(len(users)) + ' users, recently active: ' + ', '.join(recent)
+                degraded.append('users')
+            elif history_tokens:
+                # Drop just enough of the oldest history
+                dropped = 0
+                while history_tokens and dropped < over:
+                    dropped += history_tokens.pop(0)
+                history = history[len(history) - len(history_tokens):]
+                degraded.append('history')
+            elif summary:
+                summary = []
+                degraded.append('summary')
+            else:
+                # Nothing left to give up
+                break
+
+        messages = [{"role": "system", "content": sentence} for sentence in sentences] + summary + list(history)
+        sections['total'] = sum(sections.values())
+        sections['budget'] = budget
+        sections['degraded'] = degraded
+        return messages, sections
+
+
+class BotSettings:
+    """Everything the bot reads while running, loaded from and saved to config.ini.
+
+    The GUI copies its widgets into this whenever they change, so the bot never reads Tk state. In headless mode
+    this is the only configuration there is.
+    """
+
+    DEFAULT_CONTEXT = ("You are a twitch chatbot, your username is <name> and your pronouns "
+                       "are They/Them. The name of the streamer is <channel> and their "
+                       "pronouns are <streamer_pronouns>. The streamer is playing <game>. The "
+                       "name of the chatter is <author> and their pronouns are "
+                       "<chatter_pronouns>. The current date and time are: <time>. A list of "
+                       "users in chat are: <users>. Global twitch emotes that you can use are"
+                       " <emotes>.")
+
+    # Where the bot finds Twitch and the other services, an [Endpoints] section in config.ini overrides them
+    DEFAULT_ENDPOINTS = {
+        'irc': 'irc.chat.twitch.tv:6667',
+        'auth': 'https://id.twitch.tv/oauth2',
+        'helix': 'https://api.twitch.tv/helix',
+        'eventsub': 'wss://eventsub.wss.twitch.tv/ws',
+        'pronouns': 'https://pronouns.alejo.io/api',
+        'launches': 'https://ll.thespacedevs.com/2.2.0',
+        'igdb': 'https://api.igdb.com/v4',
+        'openai': 'https://api.openai.com/v1',
+    }
+
+    def __init__(self):
+        self.username = ''
+        self.client_id = ''
+        self.client_secret = ''
+        self.bot_token = ''
+        self.refresh_token = ''
+        self.channel = ''
+        self.openai_api_key = ''
+        self.context = self.DEFAULT_CONTEXT
+        self.model = 'gpt-4-0613'
+        self.frequency = 0
+        self.ignore_userlist = 0
+        self.mute = False
+
+        # Seconds a local model may sit unused before it is unloaded, 0 keeps it loaded
+        self.model_idle_timeout = 600
+
+        # Reply generation workers, how many replies may wait for one and how many seconds they may wait
+        self.reply_workers = 2
+        self.reply_queue_size = 20
+        self.reply_max_age = 30
+
+        # Seconds an outgoing chat message may wait for the rate limit before it is dropped
+        self.send_max_latency = 10
+
+        # Stream OpenAI replies and stop generating once the reply no longer fits in one chat message
+        self.stream_replies = 1
+
+        # Most tokens a reply's prompt may use, 0 uses the model's default from PromptBuilder.BUDGETS
+        self.prompt_token_budget = 0
+
+        # Model that folds older chat into a running summary, a local model or a cheap OpenAI one. Off (empty) unless
+        # set, an OpenAI model is billed for every summary.
+        self.summary_model = ''
+        # Fewest seconds between summaries of the same channel
+        self.summary_interval = 300
+
+        # Bytes of chat journal kept per channel file before it is rotated, 0 turns the journal off
+        self.journal_max_bytes = 1024 * 1024
+
+        # Journaled chat younger than this many seconds is put back into the history when the bot starts
+        self.journal_replay_age = 3600
+
+        # Seconds before the cached channel info (game, title) is refetched if EventSub didn't update it
+        self.channel_info_ttl = 300
+
+        # Seconds the sampling profiler runs for when it is started without a duration
+        self.profile_seconds = 30
+
+        # Port serving Prometheus metrics at /metrics, 0 turns it off, and the address it listens on
+        self.metrics_port = 0
+        self.metrics_host = '127.0.0.1'
+
+        # Per channel InputString and Frequency, from [Channel:<name>] sections
+        self.channel_overrides = {}
+
+        self.endpoints = dict(self.DEFAULT_ENDPOINTS)
+
+    def channels(self):
+        return [name.strip().lstrip('#').lower() for name in self.channel.split(',') if name.strip()]
+
+    def context_for(self, channel):
+        return self.channel_overrides.get(channel.lstrip('#'), {}).get('InputString') or self.context
+
+    def frequency_for(self, channel):
+        return float(self.channel_overrides.get(channel.lstrip('#'), {}).get('Frequency', self.frequency))
+
+    def load(self, path='config.ini'):
+        config = configparser.ConfigParser()
+        if not config.read(path):
+            return False
+
+        section = config['TwitchBot']
+        self.username = section.get('username', '')
+        self.client_id = section.get('ClientID', '')
+        self.client_secret = section.get('ClientSecret', '')
+        self.bot_token = section.get('BotOAuthToken', '')
+        self.refresh_token = section.get('RefreshToken', '')
+        self.channel = section.get('InitialChannels', '')
+        self.openai_api_key = section.get('OpenAIAPIKey', '')
+        self.context = section.get('InputString', '') or self.DEFAULT_CONTEXT
+        self.model = section.get('Model', '') or 'gpt-4-0613'
+        self.frequency = int(float(section.get('Frequency', '') or 0))
+        self.ignore_userlist = int(section.get('IgnoreUsers', '0'))
+        self.model_idle_timeout = int(section.get('ModelIdleTimeout', '600'))
+        self.reply_workers = int(section.get('ReplyWorkers', '2'))
+        self.reply_queue_size = int(section.get('ReplyQueueSize', '20'))
+        self.reply_max_age = int(section.get('ReplyMaxAge', '30'))
+        self.send_max_latency = int(section.get('SendMaxLatency', '10'))
+        self.stream_replies = int(section.get('StreamReplies', '1'))
+        self.prompt_token_budget = int(section.get('PromptTokenBudget', '0'))
+        self.summary_model = section.get('SummaryModel', '')
+        self.summary_interval = int(section.get('SummaryInterval', '300'))
+        self.journal_max_bytes = int(section.get('JournalMaxBytes', '1048576'))
+        self.journal_replay_age = int(section.get('JournalReplayAge', '3600'))
+        self.channel_info_ttl = int(section.get('ChannelInfoTTL', '300'))
+        self.profile_seconds = int(section.get('ProfileSeconds', '30'))
+        self.metrics_port = int(section.get('MetricsPort', '0'))
+        self.metrics_host = section.get('MetricsHost', '127.0.0.1')
+
+        self.channel_overrides = {}
+        for name in config.sections():
+            if name.startswith('Channel:'):
+                overrides = {key: config[name][key] for key in ('InputString', 'Frequency') if key in config[name]}
+                self.channel_overrides[name[len('Channel:'):].lower()] = overrides
+        self.endpoints = dict(self.DEFAULT_ENDPOINTS)
+        if config.has_section('Endpoints'):
+            self.endpoints.update(config['Endpoints'])
+        return True
+
+    def save(self, path='config.ini'):
+        config = configparser.ConfigParser()
+        config['TwitchBot'] = {
+            'username': self.username,
+            'ClientID': self.client_id,
+            'ClientSecret': self.client_secret,
+            'BotOAuthToken': self.bot_token,
+            'RefreshToken': self.refresh_token,
+            'InitialChannels': self.channel,
+            'OpenAIAPIKey': self.openai_api_key,
+            'InputString': self.context,
+            'Model': self.model,
+            'Frequency': self.frequency,
+            'IgnoreUsers': self.ignore_userlist,
+            'ModelIdleTimeout': self.model_idle_timeout,
+            'ReplyWorkers': self.reply_workers,
+            'ReplyQueueSize': self.reply_queue_size,
+            'ReplyMaxAge': self.reply_max_age,
+            'SendMaxLatency': self.send_max_latency,
+            'StreamReplies': self.stream_replies,
+            'PromptTokenBudget': self.prompt_token_budget,
+            'SummaryModel': self.summary_model,
+            'SummaryInterval': self.summary_interval,
+            'JournalMaxBytes': self.journal_max_bytes,
+            'JournalReplayAge': self.journal_replay_age,
+            'ChannelInfoTTL': self.channel_info_ttl,
+            'ProfileSeconds': self.profile_seconds,
+            'MetricsPort': self.metrics_port,
+            'MetricsHost': self.metrics_host
+        }
+        for name, overrides in self.channel_overrides.items():
+            config['Channel:' + name] = overrides
+        endpoints = {key: url for key, url in self.endpoints.items() if url != self.DEFAULT_ENDPOINTS.get(key)}
+        if endpoints:
+            config['Endpoints'] = endpoints
+
+        with open(path, 'w') as configfile:
+            config.write(configfile)
+
+
+class BotCore:
+    """Runs the bot from BotSettings and owns what outlives a single bot run.
+
+    The HTTP client, the user cache and the local model process are shared across restarts. An observer (the GUI)
+    can be attached to receive log lines, user list changes and refreshed tokens, the bot runs the same without one.
+    """
+
+    def __init__(self, settings, config_path='config.ini', observer=None, send_budget=None, join_budget=None,
+                 refresh=None):
+        self.settings = settings
+        self.config_path = config_path
+        self.observer = observer
+        self.running = False
+        self.bot = None
+
+        # Twitch rate limits are per account, shard processes share these
+        self.send_budget = send_budget if send_budget is not None else RateBudget(SendQueue.USER_LIMIT,
+                                                                                  SendQueue.WINDOW)
+        self.join_budget = join_budget if join_budget is not None else RateBudget(TwitchBot.JOIN_LIMIT,
+                                                                                  TwitchBot.JOIN_WINDOW)
+
+        # Users and pronouns are kept between runs
+        directory = os.path.dirname(os.path.abspath(config_path))
+        self.cache = PersistentCache(os.path.join(directory, 'cache.db'))
+
+        # How long each stage of a reply takes, shown in the GUI and by the stats command
+        self.latency = LatencyStats()
+
+        # Profiles a live bot on request, from the GUI, chat or SIGUSR1
+        self.profiler = SamplingProfiler(directory, self.log)
+
+        # Counters for the metrics endpoint, which is started with the bot when MetricsPort is set
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        # Chat history is journaled next to the config so it survives reconnects and restarts
+        self.journal = ChatJournal(os.path.join(directory, 'journal'), settings.journal_max_bytes)
+
+        # One pooled HTTP client for everything, the token refresh is shared between threads. A shard passes its own
+        # refresh, which asks the supervisor for the token.
+        self.http = HttpClient(refresh or self.refresh_login, lambda: self.settings.bot_token)
+
+        # Local models are loaded by a separate process and stay loaded across replies and bot restarts
+        self.inference_server = InferenceServer(settings.model_idle_timeout, log_callback=self.log)
+
+    def log(self, message):
+        if self.observer is not None:
+            self.observer.append_to_log(message)
+
+    def add_users(self, channel, logins):
+        if self.observer is not None:
+            self.observer.add_users(channel, logins)
+
+    def remove_user(self, channel, login):
+        if self.observer is not None:
+            self.observer.remove_user(channel, login)
+
+    def refresh_login(self):
+        auth_params = {
+            'client_id': self.settings.client_id,
+            'client_secret': self.settings.client_secret,
+            'grant_type': 'refresh_token',
+            'refresh_token': self.settings.refresh_token,
+        }
+        response = self.http.post(self.settings.endpoints['auth'] + '/token', data=auth_params)
+        data = response.json()
+        self.settings.bot_token = data['access_token']
+        self.settings.refresh_token = data['refresh_token']
+        if self.observer is not None:
+            self.observer.update_tokens()
+        else:
+            self.settings.save(self.config_path)
+
+    def start(self, refresh=True):
+        if not self.settings.channels():
+            raise ValueError('No channels to join, set InitialChannels')
+        if refresh:
+            self.refresh_login()
+        self.running = True
+        self.start_metrics()
+
+        # Load the local model now so the first reply doesn't wait on it
+        self.inference_server.warm(self.settings.model)
+
+    def start_metrics(self):
+        port = self.settings.metrics_port
+        if not port or self.metrics_server is not None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self, self.settings.metrics_host, port)
+        except OSError as e:
+            print('Could not serve metrics on port ' + str(port) + ': ' + str(e))
+            self.log('Could not serve metrics on port ' + str(port) + ': ' + str(e))
+            return
+        print('Serving metrics on http://' + self.settings.metrics_host + ':' + str(port) + '/metrics')
+        self.log('Serving metrics on port ' + str(port))
+
+    def profile(self, seconds=None):
+        # Returns where the profile will be written, or None while one is already running
+        seconds = seconds or self.settings.profile_seconds
+        path = self.profiler.start(seconds)
+        if path is None:
+            print('A profile is already running')
+            self.log('A profile is already running')
+            return None
+        print('Profiling every thread for ' + str(seconds) + ' s')
+        self.log('Profiling every thread for ' + str(seconds) + ' s')
+        return path
+
+    def install_profile_signal(self):
+        # kill -USR1 <pid> profiles a running bot. Windows has no SIGUSR1, and only the main thread may set handlers.
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.profile())
+
+    def run_bot(self):
+        # Blocks while the bot is connected
+        self.bot = TwitchBot(self)
+        self.bot.start()
+
+    def stop(self):
+        self.running = False
+        self.inference_server.cancel_all()
+        if self.bot is not None:
+            self.bot.shutdown()
+
+    def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        self.inference_server.close()
+        self.cache.close()
+        self.journal.close()
+
+
+def run_headless(config_path):
+    settings = BotSettings()
+    if not settings.load(config_path):
+        print('Could not read ' + config_path)
+        return 1
+
+    if not settings.channels():
+        print('No channels to join, set InitialChannels in ' + config_path)
+        return 1
+
+    core = BotCore(settings, config_path)
+    core.install_profile_signal()
+    try:
+        core.start()
+        core.run_bot()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        core.stop()
+        core.close()
+        print("Stopped")
+    return 0
+
+
+class ShardObserver:
+    """Stands in for the GUI in a shard worker.
+
+    Shards never refresh the token themselves, a refresh in one would invalidate the refresh token the others hold.
+    refresh_tokens() asks the supervisor instead, which refreshes once, saves config.ini and sends the new tokens to
+    every shard.
+    """
+
+    REFRESH_TIMEOUT = 30
+
+    def __init__(self, settings, shard, refresh_queue):
+        self.settings = settings
+        self.shard = shard
+        self.refresh_queue = refresh_queue
+        self.tokens_received = threading.Event()
+
+    def refresh_tokens(self):
+        # Called by the HTTP client on a 401, which lets one thread of the shard do this at a time
+        self.tokens_received.clear()
+        self.refresh_queue.put(('refresh', self.shard, self.settings.bot_token))
+        if not self.tokens_received.wait(self.REFRESH_TIMEOUT):
+            raise RuntimeError('The supervisor did not send a refreshed token')
+
+    def set_tokens(self, bot_token, refresh_token):
+        self.settings.bot_token = bot_token
+        self.settings.refresh_token = refresh_token
+        self.tokens_received.set()
+
+    def append_to_log(self, message):
+        pass
+
+    def add_users(self, channel, logins):
+        pass
+
+    def remove_user(self, channel, login):
+        pass
+
+    def update_tokens(self):
+        # The supervisor saves the tokens it refreshed
+        pass
+
+
+def shard_worker(config_path, shard, channels, control_queue, refresh_queue, send_budget, join_budget):
+    # Runs in a shard process, the bot connects on a thread while this one waits for the supervisor
+    settings = BotSettings()
+    settings.load(config_path)
+    settings.channel = ','.join(channels)
+    # Every shard serves its own metrics, on the ports after MetricsPort
+    if settings.metrics_port:
+        settings.metrics_port += shard
+    observer = ShardObserver(settings, shard, refresh_queue)
+    core = BotCore(settings, config_path, observer, send_budget, join_budget, refresh=observer.refresh_tokens)
+    core.install_profile_signal()
+    # The supervisor already refreshed the token for every shard
+    core.start(refresh=False)
+    bot_thread = threading.Thread(target=core.run_bot)
+    bot_thread.daemon = True
+    bot_thread.start()
+
+    pending = []
+    stopped = False
+    try:
+        while bot_thread.is_alive():
+            try:
+                command = control_queue.get(timeout=1)
+                if command[0] == 'stop':
+                    stopped = True
+                    break
+                elif command[0] == 'tokens':
+                    observer.set_tokens(command[1], command[2])
+                else:
+                    pending.extend(command[1])
+            except queue.Empty:
+                pass
+            # Channels moved here are added on the bot's loop once the bot exists
+            if pending and core.bot is not None:
+                print('Shard ' + str(shard) + ' taking over ' + ', '.join(pending))
+                asyncio.run_coroutine_threadsafe(core.bot.add_channels(pending), core.bot.loop)
+                pending = []
+    except KeyboardInterrupt:
+        stopped = True
+    finally:
+        core.stop()
+        core.close()
+    # A bot that died on its own exits non-zero so the supervisor moves its channels
+    sys.exit(0 if stopped else 1)
+
+
+class ShardSupervisor:
+    """Runs the configured channels across several headless bot processes.
+
+    Channels are dealt out round-robin, every shard draws from the same per-account send and JOIN budgets, and
+    the channels of a shard that dies are moved to the shards still running. The supervisor is also the only one
+    that refreshes the token, when a shard asks for it.
+    """
+
+    CHECK_INTERVAL = 5
+    RESTART_DELAY = 30
+
+    def __init__(self, settings, config_path, shards):
+        self.settings = settings
+        self.config_path = config_path
+        self.shards = max(1, min(shards, len(settings.channels())))
+        self.context = multiprocessing.get_context('spawn')
+        self.send_budget = RateBudget(SendQueue.USER_LIMIT, SendQueue.WINDOW)
+        self.join_budget = RateBudget(TwitchBot.JOIN_LIMIT, TwitchBot.JOIN_WINDOW)
+        self.shard_ids = itertools.count()
+        # shard -> [process, control queue, channels]
+        self.workers = {}
+        # Token refresh requests from the shards
+        self.refresh_queue = self.context.Queue()
+        self.core = None
+
+    def start_worker(self, channels):
+        shard = next(self.shard_ids)
+        control_queue = self.context.Queue()
+        process = self.context.Process(target=shard_worker,
+                                       args=(self.config_path, shard, channels, control_queue, self.refresh_queue,
+                                             self.send_budget, self.join_budget))
+        process.daemon = True
+        process.start()
+        self.workers[shard] = [process, control_queue, list(channels)]
+        print('Started shard ' + str(shard) + ' with ' + str(len(channels)) + ' channels')
+
+    def rebalance(self, channels):
+        # Hand the channels one at a time to the least loaded shard
+        live = [worker for worker in self.workers.values() if worker[0].is_alive()]
+        if not live:
+            time.sleep(self.RESTART_DELAY)
+            self.start_worker(channels)
+            return
+        moved = {}
+        for name in channels:
+            worker = min(live, key=lambda w: len(w[2]))
+            worker[2].append(name)
+            moved.setdefault(id(worker), (worker, []))[1].append(name)
+        for worker, names in moved.values():
+            worker[1].put(('join', names))
+
+    def run(self):
+        # Refresh once here, a refresh in each shard would invalidate the others' refresh token
+        self.core = BotCore(self.settings, self.config_path)
+        self.core.refresh_login()
+
+        channels = self.settings.channels()
+        for shard in range(self.shards):
+            self.start_worker(channels[shard::self.shards])
+
+        next_check = time.monotonic() + self.CHECK_INTERVAL
+        while True:
+            try:
+                request = self.refresh_queue.get(timeout=max(next_check - time.monotonic(), 0))
+                self.refresh_tokens(request[1], request[2])
+            except queue.Empty:
+                pass
+            if time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + self.CHECK_INTERVAL
+            for shard, worker in list(self.workers.items()):
+                if worker[0].is_alive():
+                    continue
+                del self.workers[shard]
+                print('Shard ' + str(shard) + ' exited with ' + str(worker[0].exitcode) + ', moving '
+                      + str(len(worker[2])) + ' channels')
+                self.rebalance(worker[2])
+
+    def refresh_tokens(self, shard, stale_token):
+        # Shards that hit a 401 together all send the token they had, only the first one causes a refresh
+        if stale_token == self.settings.bot_token:
+            print('Shard ' + str(shard) + ' asked for a new token, refreshing')
+            try:
+                self.core.refresh_login()
+            except Exception as e:
+                print('Error refreshing the token for the shards: ' + str(e))
+        for worker in self.workers.values():
+            if worker[0].is_alive():
+                worker[1].put(('tokens', self.settings.bot_token, self.settings.refresh_token))
+
+    def stop(self):
+        for worker in self.workers.values():
+            if worker[0].is_alive():
+                worker[1].put(('stop',))
+        for worker in self.workers.values():
+            worker[0].join(10)
+            if worker[0].is_alive():
+                worker[0].terminate()
+        if self.core:
+            self.core.close()
+
+
+def run_sharded(config_path, shards):
+    settings = BotSettings()
+    if not settings.load(config_path):
+        print('Could not read ' + config_path)
+        return 1
+    if not settings.channels():
+        print('No channels to join, set InitialChannels in ' + config_path)
+        return 1
+    if settings.model in LOCAL_MODELS:
+        print('Warning: every shard loads its own copy of ' + settings.model)
+
+    supervisor = ShardSupervisor(settings, config_path, shards)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        print("Stopped")
+    return 0
+
+
 class TwitchBotGUI(tk.Tk):
+    # Milliseconds between GUI updates, log lines kept on screen and log lines allowed to wait for the next update
+    GUI_UPDATE_INTERVAL = 100
+    MAX_LOG_LINES = 5000
+    MAX_QUEUED_LOG_LINES = 10000
+    # Milliseconds between refreshes of the stats window
+    STATS_UPDATE_INTERVAL = 1000
 
     def __init__(self):
         super().__init__()
@@ -70,16 +2359,22 @@ class TwitchBotGUI(tk.Tk):
         self.openai_api_model = tk.StringVar()
         self.ignore_userlist = IntVar()
 
+        # What the bot runs from, kept in sync with the widgets
+        self.settings = BotSettings()
+
         # Variable to keep track of the bot state
         self.bot_running = False
 
         self.mute = False
 
+        # The reply latency window, open while not None
+        self.stats_window = None
+        self.stats_refresh = None
+
         self.openai_models = ['gpt-4', 'gpt-3.5-turbo']
-        if os.path.exists('ggml-mpt-7b-chat.bin'):
-            self.openai_models.append('mpt-7b-chat')
-        if os.path.exists('wizardlm-13b-v1.1-superhot-8k.ggmlv3.q4_0.bin'):
-            self.openai_models.append('WizardLM-13B')
+        for model_name, model_file in LOCAL_MODELS.items():
+            if os.path.exists(model_file):
+                self.openai_models.append(model_name)
 
         self.create_widgets()
 
@@ -92,18 +2387,33 @@ class TwitchBotGUI(tk.Tk):
         self.protocol("WM_DELETE_WINDOW", self.on_exit)
 
         # Initialize a Queue for handling log messages
-        self.log_queue = queue.Queue()
+        self.log_queue = queue.Queue(maxsize=self.MAX_QUEUED_LOG_LINES)
+        self.dropped_log_lines = 0
+
+        # User list changes from the bot, applied by the GUI pump: ('add', [logins]), ('remove', login), ('clear',)
+        self.user_updates = collections.deque()
+        # What the user Listbox holds, in order, so updates can be applied without rebuilding it
+        self.user_rows = []
+        self.user_set = set()
+        # Tokens refreshed on the bot's threads, and calls the bot's threads want made on the Tk thread
+        self.token_updates = collections.deque()
+        self.gui_calls = collections.deque()
+
+        # Apply log and user list updates on the Tk thread
+        self.after(self.GUI_UPDATE_INTERVAL, self.process_log_queue)
 
-        # Start a separate thread to update the log asynchronously
-        self.log_thread = threading.Thread(target=self.process_log_queue)
-        self.log_thread.daemon = True
-        self.log_thread.start()
+        # The bot itself, this window only observes it
+        self.core = BotCore(self.settings, 'config.ini', observer=self)
+        self.core.install_profile_signal()
 
     # Function to handle selection change
     def on_selection_change(self, event):
         self.openai_api_model.set(self.openai_model_entry.get())
         print(self.openai_model_entry.get() + ' set')
         self.append_to_log(self.openai_model_entry.get() + ' set')
+        self.settings.model = self.openai_api_model.get()
+        if self.bot_running:
+            self.core.inference_server.warm(self.openai_api_model.get())
 
     def show_about_popup(self):
         about_text = "pyWiki Lite " + get_version() + "\n©2023 Ixitxachitl\nAnd ChatGPT"
@@ -111,19 +2421,113 @@ class TwitchBotGUI(tk.Tk):
         thread.start()
 
     def append_to_log(self, message):
-        self.log_queue.put(message)
+        try:
+            self.log_queue.put_nowait(str(message))
+        except queue.Full:
+            # Keep the newest lines when the GUI can't keep up
+            try:
+                self.log_queue.get_nowait()
+                self.dropped_log_lines += 1
+            except queue.Empty:
+                pass
+            self.append_to_log(message)
 
     def process_log_queue(self):
+        # Runs on the Tk thread, applies everything that arrived since the last update in one go
+        messages = []
         while True:
             try:
-                message = self.log_queue.get_nowait()
-                self.log_text.config(state=tk.NORMAL)  # Enable the Text widget for editing
-                self.log_text.insert(tk.END, message + "\n")
-                self.log_text.see(tk.END)  # Scroll to the bottom of the text widget
-                self.log_text.config(state=tk.DISABLED)  # Disable the Text widget for editing
+                messages.append(self.log_queue.get_nowait())
             except queue.Empty:
-                pass
-            time.sleep(.1)
+                break
+
+        if messages:
+            self.log_text.config(state=tk.NORMAL)  # Enable the Text widget for editing
+            self.log_text.insert(tk.END, '\n'.join(messages) + '\n')
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - self.MAX_LOG_LINES
+            if excess > 0:
+                self.log_text.delete('1.0', str(excess + 1) + '.0')
+            self.log_text.see(tk.END)  # Scroll to the bottom of the text widget
+            self.log_text.config(state=tk.DISABLED)  # Disable the Text widget for editing
+
+        if self.user_updates:
+            self.apply_user_updates()
+        self.apply_token_updates()
+        while self.gui_calls:
+            # Outside the pump, a call may open a dialog
+            self.after(0, self.gui_calls.popleft())
+
+        self.after(self.GUI_UPDATE_INTERVAL, self.process_log_queue)
+
+    def apply_user_updates(self):
+        # Only touches the rows that changed, so the selection and scroll position survive a busy channel
+        added = {}
+        removed = set()
+        while self.user_updates:
+            update = self.user_updates.popleft()
+            if update[0] == 'add':
+                for login in update[1]:
+                    if login in removed:
+                        removed.discard(login)
+                    elif login not in self.user_set:
+                        added[login] = True
+            elif update[0] == 'remove':
+                if added.pop(update[1], None) is None and update[1] in self.user_set:
+                    removed.add(update[1])
+            else:
+                self.user_list.delete(0, tk.END)
+                self.user_rows = []
+                self.user_set.clear()
+                added.clear()
+                removed.clear()
+
+        if removed:
+            # From the bottom up so the indices still to delete don't move
+            for index in reversed([index for index, login in enumerate(self.user_rows) if login in removed]):
+                self.user_list.delete(index)
+            self.user_rows = [login for login in self.user_rows if login not in removed]
+            self.user_set -= removed
+        if added:
+            self.user_list.insert(tk.END, *added)
+            self.user_rows.extend(added)
+            self.user_set.update(added)
+        self.user_count.config(text=len(self.user_rows) if self.bot_running else "")
+
+    def show_stats(self):
+        # How long each stage of a reply takes, refreshed while the window is open
+        if self.stats_window is not None:
+            self.stats_window.lift()
+            return
+        self.stats_window = tk.Toplevel(self)
+        self.stats_window.title("Reply latency")
+        self.stats_window.resizable(False, False)
+        self.stats_text = tk.Text(self.stats_window, width=72, height=26, font=("Courier", 10), state=tk.DISABLED)
+        self.stats_text.pack(padx=10, pady=(10, 0))
+        buttons = tk.Frame(self.stats_window)
+        buttons.pack(pady=10)
+        tk.Button(buttons, text="Reset", command=self.core.latency.reset).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Profile " + str(self.settings.profile_seconds) + " s",
+                  command=self.core.profile).pack(side=tk.LEFT, padx=5)
+        self.stats_window.protocol("WM_DELETE_WINDOW", self.close_stats)
+        self.refresh_stats()
+
+    def refresh_stats(self):
+        text = self.core.latency.report()
+        bot = self.core.bot
+        if self.bot_running and bot is not None:
+            text += '\n\nReplies: ' + str(bot.scheduler.stats()) + '\nSent: ' + str(bot.send_queue.stats())
+        self.stats_text.config(state=tk.NORMAL)
+        self.stats_text.delete('1.0', tk.END)
+        self.stats_text.insert(tk.END, text)
+        self.stats_text.config(state=tk.DISABLED)
+        self.stats_refresh = self.after(self.STATS_UPDATE_INTERVAL, self.refresh_stats)
+
+    def close_stats(self):
+        if self.stats_refresh is not None:
+            self.after_cancel(self.stats_refresh)
+            self.stats_refresh = None
+        self.stats_window.destroy()
+        self.stats_window = None
 
     def toggle_stay_on_top(self):
         if self.attributes("-topmost"):
@@ -142,6 +2546,7 @@ class TwitchBotGUI(tk.Tk):
             self.mute = True
             self.append_to_log('Muted')
             self.stay_mute_button.config(relief="sunken")
+        self.settings.mute = self.mute
 
     def create_widgets(self):
         # Set the column weight to make text inputs expand horizontally
@@ -212,12 +2617,16 @@ class TwitchBotGUI(tk.Tk):
         self.about_button = tk.Button(self, text="ℹ️", command=self.show_about_popup, borderwidth=0)
         self.about_button.grid(row=0, column=7, columnspan=2, sticky="e")
 
+        self.stats_button = tk.Button(self, text="⏱", command=self.show_stats, borderwidth=0)
+        self.stats_button.grid(row=0, column=4, sticky="w")
+
         self.stay_mute_button = tk.Button(self, text="🔇", font=font.Font(size=14), justify='center',
                                           command=self.toggle_mute)
         self.stay_mute_button.grid(row=6, column=0, columnspan=2, sticky="e", padx=(0, 10))
 
         # Create a slider widget
-        self.frequency_slider = tk.Scale(self, from_=0, to=100, orient=tk.HORIZONTAL)
+        self.frequency_slider = tk.Scale(self, from_=0, to=100, orient=tk.HORIZONTAL,
+                                         command=lambda value: setattr(self.settings, 'frequency', int(value)))
         self.frequency_slider.grid(row=6, column=0, columnspan=2, padx=(10, 60), pady=0, sticky="ew")
 
         self.frequency_slider.bind("<Enter>", self.on_frequency_slider_enter)
@@ -235,11 +2644,14 @@ class TwitchBotGUI(tk.Tk):
         self.input_text = tkscrolled.ScrolledText(self, wrap="word", height=22, width=40, undo=True,
                                                   autoseparators=True, maxundo=-1)
         self.input_text.grid(row=1, column=3, columnspan=2, rowspan=7, padx=(0, 10), pady=(10, 0), sticky="ne")
+        self.input_text.bind('<<Modified>>', self.on_input_text_modified)
 
         # Create a Listbox to display users
         self.ignore_userlist_check = tk.Checkbutton(self, text="Ignore User List", variable=self.ignore_userlist,
                                                     onvalue=1,
-                                                    offvalue=0)
+                                                    offvalue=0,
+                                                    command=lambda: setattr(self.settings, 'ignore_userlist',
+                                                                            self.ignore_userlist.get()))
         self.ignore_userlist_check.grid(row=1, column=5, columnspan=3, sticky='nw', pady=0)
         self.user_list_scroll = tk.Scrollbar(self, orient="vertical")
         self.user_list_scroll.grid(row=2, column=8, columnspan=1, rowspan=6, pady=0, padx=(0, 10), sticky="ns")
@@ -251,6 +2663,51 @@ class TwitchBotGUI(tk.Tk):
         self.user_list.bind('<Double-Button-1>', self.show_popup)
         self.user_list.bind('<Button-3>', self.message_user)
 
+    def on_input_text_modified(self, event):
+        if self.input_text.edit_modified():
+            self.settings.context = self.input_text.get('1.0', 'end')
+            self.input_text.edit_modified(False)
+
+    def sync_settings(self):
+        # A refreshed token not yet in the entries would be overwritten by the old one
+        self.apply_token_updates()
+        self.settings.username = self.username.get()
+        self.settings.client_id = self.client_id.get()
+        self.settings.client_secret = self.client_secret.get()
+        self.settings.bot_token = self.bot_token.get()
+        self.settings.refresh_token = self.refresh_token.get()
+        self.settings.channel = self.channel.get()
+        self.settings.openai_api_key = self.openai_api_key.get()
+        self.settings.context = self.input_text.get('1.0', 'end')
+        self.settings.model = self.openai_api_model.get()
+        self.settings.frequency = self.frequency_slider.get()
+        self.settings.ignore_userlist = self.ignore_userlist.get()
+        self.settings.mute = self.mute
+
+    def update_tokens(self):
+        # Called from whichever thread refreshed the token, the entries are updated by the GUI pump
+        self.token_updates.append((self.settings.bot_token, self.settings.refresh_token))
+
+    def apply_token_updates(self):
+        tokens = None
+        while self.token_updates:
+            tokens = self.token_updates.popleft()
+        if tokens is not None:
+            self.bot_token.set(tokens[0])
+            self.refresh_token.set(tokens[1])
+
+    def shows_channel(self, channel):
+        # The user list shows the first channel
+        return self.core.bot is not None and channel == self.core.bot.primary_channel.name
+
+    def add_users(self, channel, logins):
+        if self.shows_channel(channel):
+            self.user_updates.append(('add', list(logins)))
+
+    def remove_user(self, channel, login):
+        if self.shows_channel(channel):
+            self.user_updates.append(('remove', login))
+
     def on_frequency_slider_enter(self, event):
         self.frequency_slider.bind("<MouseWheel>", self.on_frequency_slider_scroll)
 
@@ -270,79 +2727,74 @@ class TwitchBotGUI(tk.Tk):
         if selected_index:
             item_index = int(selected_index[0])
             selected_item = self.user_list.get(item_index)
-            if selected_item.lower() in self.bot.last_message.keys():
-                thread = threading.Thread(
-                    target=lambda: self.bot.generate_response(selected_item,
-                                                              self.bot.last_message[selected_item.lower()]))
+            bot = self.core.bot
+            channel = bot.primary_channel
+            if selected_item.lower() in channel.last_message.keys():
+                bot.request_reply(ResponseScheduler.DIRECT, channel.name, selected_item,
+                                  channel.last_message[selected_item.lower()])
             else:
-                thread = threading.Thread(
-                    target=lambda: self.bot.generate_response(selected_item, '@ ' + selected_item))
-            thread.start()
+                bot.request_reply(ResponseScheduler.DIRECT, channel.name, selected_item, '@ ' + selected_item)
 
     def show_popup(self, event):
         selected_index = self.user_list.curselection()
         if selected_index:
             item_index = int(selected_index[0])
             selected_item = self.user_list.get(item_index)
-            url = 'https://api.twitch.tv/helix/users?login=' + selected_item
-            headers = {
-                'Authorization': 'Bearer ' + self.bot_token.get(),
-                'Client-Id': self.client_id.get(),
-                'Content-Type': 'application/json',
-            }
-            while True:
-                response = requests.get(url, headers=headers)
+            bot = self.core.bot
+            if bot is None:
+                return
+
+            async def lookup():
+                user = await bot.get_user(selected_item)
+                if not isinstance(user, dict):
+                    return user, None
+                return user, await bot.get_followage(selected_item, channel=bot.primary_channel.name)
+
+            # Looked up on the bot's loop, the Tk thread never waits for it
+            future = asyncio.run_coroutine_threadsafe(lookup(), bot.loop)
+            future.add_done_callback(lambda done: self.gui_calls.append(
+                lambda: self.show_user_info(selected_item, done)))
+
+    def show_user_info(self, selected_item, future):
+        try:
+            user, followed_at = future.result()
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if not isinstance(user, dict):
+            messagebox.showerror("Error", user)
+            return
 
-                if response.status_code == 200:
-                    break
-                elif response.status_code == 401:
-                    self.refresh_login()
-                else:
-                    # Handle other status codes if needed
-                    messagebox.showerror("Error", "Error fetching data: " + str(response.status_code))
-                    return
+        # Now you can safely access the data from the response
+        try:
+            created_at = user['created_at']
 
-            # Now you can safely access the data from the response
             try:
-                created_at = response.json()['data'][0]['created_at']
-                followed_at = self.bot.get_followage(selected_item)
-
-                try:
-                    con_followed_at = datetime.strptime(followed_at, '%Y-%m-%dT%H:%M:%SZ')
-                    follow_time = relativedelta(datetime.utcnow(), con_followed_at)
-
-                    time_units = [('year', follow_time.years), ('month', follow_time.months), ('day', follow_time.days),
-                                  ('hour', follow_time.hours)]
-                    time_strings = [f"{value} {unit}" if value == 1 else f"{value} {unit}s" for unit, value in
-                                    time_units if
-                                    value > 0]
-                    time_string = ', '.join(time_strings)
-                except ValueError:
-                    time_string = ''
-
-                thread = threading.Thread(target=lambda: messagebox.showinfo(selected_item, 'Created on: ' + created_at
-                                                                             + '\nFollowed on: ' + followed_at + '\n' +
-                                                                             time_string))
-                thread.start()
-            except KeyError:
-                messagebox.showerror("Error", "Error parsing response data")
-            except IndexError:
-                messagebox.showerror("Error", "Missing response data")
+                con_followed_at = datetime.strptime(followed_at, '%Y-%m-%dT%H:%M:%SZ')
+                follow_time = relativedelta(datetime.utcnow(), con_followed_at)
+
+                time_units = [('year', follow_time.years), ('month', follow_time.months), ('day', follow_time.days),
+                              ('hour', follow_time.hours)]
+                time_strings = [f"{value} {unit}" if value == 1 else f"{value} {unit}s" for unit, value in
+                                time_units if
+                                value > 0]
+                time_string = ', '.join(time_strings)
+            except ValueError:
+                time_string = ''
+
+            messagebox.showinfo(selected_item, 'Created on: ' + created_at + '\nFollowed on: ' + followed_at + '\n'
+                                + time_string)
+        except KeyError:
+            messagebox.showerror("Error", "Error parsing response data")
+        except IndexError:
+            messagebox.showerror("Error", "Missing response data")
 
     def twitch_login(self):
         self.open_browser_and_start_server()
 
     def refresh_login(self):
-        auth_params = {
-            'client_id': self.client_id.get(),
-            'client_secret': self.client_secret.get(),
-            'grant_type': 'refresh_token',
-            'refresh_token': self.refresh_token.get(),
-        }
-        response = requests.post('https://id.twitch.tv/oauth2/token', data=auth_params)
-        data = response.json()
-        self.bot_token.set(data['access_token'])
-        self.refresh_token.set(data['refresh_token'])
+        self.sync_settings()
+        self.core.refresh_login()
 
     def open_browser_and_start_server(self):
         print('Logging in...')
@@ -355,7 +2807,8 @@ class TwitchBotGUI(tk.Tk):
             'scope': 'chat:read+chat:edit+channel:moderate+whispers:read+whispers:edit+channel_editor+user:read:follows+moderator:read:followers+channel:read:redemptions',
             'force_verify': 'true',
         }
-        auth_url = 'https://id.twitch.tv/oauth2/authorize?' + '&'.join([f'{k}={v}' for k, v in auth_params.items()])
+        auth_url = (self.settings.endpoints['auth'] + '/authorize?'
+                    + '&'.join([f'{k}={v}' for k, v in auth_params.items()]))
         webbrowser.open(auth_url)
 
         # Start the server in a separate thread
@@ -372,96 +2825,49 @@ class TwitchBotGUI(tk.Tk):
             print(f"Error occurred while writing to {file_path}: {e}")
 
     def load_configuration(self):
-        config = configparser.ConfigParser()
-        if not config.read('config.ini'):
+        if not self.settings.load('config.ini'):
             return
 
-        section = config['TwitchBot']
-        self.username.set(section.get('username', ''))
-        self.client_id.set(section.get('ClientID', ''))
-        self.client_secret.set(section.get('ClientSecret', ''))
-        self.bot_token.set(section.get('BotOAuthToken', ''))
-        self.refresh_token.set(section.get('RefreshToken', ''))
-        self.channel.set(section.get('InitialChannels', ''))
-        self.openai_api_key.set(section.get('OpenAIAPIKey', ''))
-        if not section.get('InputString', ''):
-            self.input_text.insert(tk.END, "You are a twitch chatbot, your username is <name> and your pronouns "
-                                           "are They/Them. The name of the streamer is <channel> and their "
-                                           "pronouns are <streamer_pronouns>. The streamer is playing <game>. The "
-                                           "name of the chatter is <author> and their pronouns are "
-                                           "<chatter_pronouns>. The current date and time are: <time>. A list of "
-                                           "users in chat are: <users>. Global twitch emotes that you can use are"
-                                           " <emotes>.")
-        else:
-            self.input_text.insert(tk.END, section.get('InputString', ''))
-
-        if not section.get('Model', ''):
-            self.openai_api_model.set('gpt-4-0613')
-        else:
-            self.openai_api_model.set(section.get('Model', ''))
-
-        if not section.get('Frequency', ''):
-            self.frequency_slider.set(0)
-        else:
-            self.frequency_slider.set(section.get('Frequency', ''))
-
-        self.ignore_userlist.set(int(section.get('IgnoreUsers', '0')))
+        self.username.set(self.settings.username)
+        self.client_id.set(self.settings.client_id)
+        self.client_secret.set(self.settings.client_secret)
+        self.bot_token.set(self.settings.bot_token)
+        self.refresh_token.set(self.settings.refresh_token)
+        self.channel.set(self.settings.channel)
+        self.openai_api_key.set(self.settings.openai_api_key)
+        self.input_text.delete('1.0', tk.END)
+        self.input_text.insert(tk.END, self.settings.context)
+        self.openai_api_model.set(self.settings.model)
+        self.frequency_slider.set(self.settings.frequency)
+        self.ignore_userlist.set(self.settings.ignore_userlist)
 
     def save_configuration(self):
-        config = configparser.ConfigParser()
-        config['TwitchBot'] = {
-            'username': self.username.get(),
-            'ClientID': self.client_id.get(),
-            'ClientSecret': self.client_secret.get(),
-            'BotOAuthToken': self.bot_token.get(),
-            'RefreshToken': self.refresh_token.get(),
-            'InitialChannels': self.channel.get(),
-            'OpenAIAPIKey': self.openai_api_key.get(),
-            'InputString': self.input_text.get('1.0', 'end'),
-            'Model': self.openai_api_model.get(),
-            'Frequency': self.frequency_slider.get(),
-            'IgnoreUsers': self.ignore_userlist.get()
-        }
-
-        with open('config.ini', 'w') as configfile:
-            config.write(configfile)
+        self.sync_settings()
+        self.settings.save('config.ini')
 
     def start_bot(self):
         if not self.bot_running:
-            self.refresh_login()
+            self.sync_settings()
+            self.core.start()
             self.bot_running = True
             self.bot_toggle_button.config(text="Stop Bot")
 
             # Start the bot in a separate thread
-            self.bot_thread = threading.Thread(target=self.run_bot, daemon=False)
+            self.bot_thread = threading.Thread(target=self.core.run_bot, daemon=False)
             self.bot_thread.start()
             return
 
-    def run_bot(self):
-        # This method will be executed in a separate thread
-        # Create and run the bot here
-        self.bot = TwitchBot(self.username.get(), self.client_id.get(), self.client_secret.get(), self.bot_token.get(),
-                             self.channel.get(), self.openai_api_key.get())
-        self.bot.start()
-        return
-
     def stop_bot(self):
         if self.bot_running:
             self.bot_running = False
             self.bot_toggle_button.config(text="Start Bot")
             self.write_to_text_file("log.txt", self.log_text.get("1.0", tk.END).strip())
-            self.user_list.delete(0, tk.END)
-            app.user_count.config(text="")
-            if hasattr(self, "bot"):
-                try:
-                    self.bot.connection.quit()
-                    self.bot.disconnect()
-                except Exception as e:
-                    print(e)
+            self.user_updates.append(('clear',))
+            if self.core.bot is not None:
+                self.core.stop()
                 # self.bot.die()
                 # self.bot_thread.join()
                 self.terminate_thread(self.bot_thread)
-                self.bot.users = []
                 print("Stopped")
                 self.append_to_log("Stopped")
 
@@ -487,6 +2893,7 @@ class TwitchBotGUI(tk.Tk):
     def on_exit(self):
         self.save_configuration()
         self.stop_bot()
+        self.core.close()
         self.destroy()
 
     def toggle_bot(self):
@@ -500,6 +2907,10 @@ class TwitchBotGUI(tk.Tk):
             self.openai_api_key_entry.config(state="normal")
             self.stop_bot()
         else:
+            self.sync_settings()
+            if not self.settings.channels():
+                messagebox.showerror("Error", "No channels to join, enter at least one channel")
+                return
             self.bot_toggle_button.config(relief="sunken")
             self.login_button.config(state=tk.DISABLED)
             self.client_id_entry.config(state="disabled")
@@ -528,18 +2939,18 @@ class CallbackHandler(BaseHTTPRequestHandler):
             'redirect_uri': 'http://localhost:3000',
         }
 
-        response = requests.post('https://id.twitch.tv/oauth2/token', data=token_params)
+        response = app.core.http.post(app.settings.endpoints['auth'] + '/token', data=token_params)
         data = response.json()
         access_token = data['access_token']
         refresh_token = data['refresh_token']
         print('Access Token: ' + access_token)
         print('Refresh Token: ' + refresh_token)
 
-        url = 'https://api.twitch.tv/helix/users'
+        url = app.settings.endpoints['helix'] + '/users'
         headers = {'Authorization': 'Bearer ' + access_token,
                    'Client-ID': app.client_id.get(),
                    'Content-Type': 'application/json'}
-        response = requests.get(url, headers=headers).json()
+        response = app.core.http.get(url, headers=headers).json()
         username = response['data'][0]['login']
         print('Login: ' + username)
 
@@ -552,33 +2963,82 @@ class CallbackHandler(BaseHTTPRequestHandler):
 
 
 class TwitchBot(irc.bot.SingleServerIRCBot):
-    def __init__(self, username, client_id, client_secret, token, channel, openai_api_key):
+    """The bot's IRC connection, message handlers and Twitch/OpenAI lookups.
+
+    Everything runs as callbacks and coroutines on one asyncio loop per run: the IRC connection (irc.client_aio),
+    reply generation, sending, joins, prefetching and delayed messages. Other threads hand work to the loop with
+    call() or request_reply().
+    """
+
+    reactor_class = irc.client_aio.AioReactor
+
+    # Twitch allows 20 JOINs per 10 seconds per account
+    JOIN_LIMIT = 20
+    JOIN_WINDOW = 10
+    OPENAI_TIMEOUT = 60
+    # Longest PRIVMSG line Twitch accepts, in bytes
+    MESSAGE_BYTES = 488
+    SENTENCE_END = re.compile(r'[.!?](?=\s|$)')
+    SUMMARY_PROMPT = ("You keep the notes for a twitch chatbot. Update the summary of the chat with the new messages. "
+                      "Keep who said what and anything the chat may bring up again, drop greetings and spam. "
+                      "Answer with the summary only, in under 80 words.")
+    # The summary is part of every prompt, so its size is capped
+    SUMMARY_TOKENS = 150
+    SUMMARY_CHARS = 600
+    MAX_RECONNECT_DELAY = 300
+    # Longest profile a moderator can ask for from chat
+    MAX_PROFILE_SECONDS = 300
+
+    def __init__(self, core):
+        self.core = core
+        settings = core.settings
+        username = settings.username
+        token = settings.bot_token
         self.username = username
-        self.client_id = client_id
-        self.client_secret = client_secret
+        self.client_id = settings.client_id
+        self.client_secret = settings.client_secret
         self.token = token
-        self.channel = '#' + channel
 
-        self.client_credentials = requests.post('https://id.twitch.tv/oauth2/token?client_id='
-                                                + self.client_id
-                                                + '&client_secret='
-                                                + self.client_secret
-                                                + '&grant_type=client_credentials'
-                                                + '').json()
+        self.endpoints = dict(settings.endpoints)
+        self.client_credentials = self.core.http.post(self.endpoints['auth'] + '/token?client_id='
+                                                      + self.client_id
+                                                      + '&client_secret='
+                                                      + self.client_secret
+                                                      + '&grant_type=client_credentials'
+                                                      + '').json()
 
         print(self.client_credentials)
-        self.openai_api_key = openai_api_key
+        self.openai_api_key = settings.openai_api_key
         openai.api_key = self.openai_api_key
+        openai.api_base = self.endpoints['openai']
 
-        self.pronoun_cache = {}
-        self.users = []
-        self.message_queue = collections.deque(maxlen=10)
-        self.last_message = {}
+        # The reactor picks up the thread's loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tasks = set()
+        self.closing = False
+        self.reconnect_delay = 2
+
+        self.scheduler = ResponseScheduler(self.generate_response, self.loop, settings.reply_workers,
+                                           settings.reply_queue_size, settings.reply_max_age, core.latency)
+        self.send_queue = SendQueue(self.write_message, self.loop, settings.send_max_latency,
+                                    budget=core.send_budget, latency=core.latency)
 
         self.verify()
-        self.channel_id = self.get_channel_id(channel)
-        self.user_id = self.get_channel_id(username)
-        self.emotes = self.get_emotes()
+        self.channel_states = {}
+        self.loop.run_until_complete(self.setup(settings.channels()))
+        self.primary_channel = next(iter(self.channel_states.values()))
+        self.channel_info = ChannelInfoCache(self.get_channels_info,
+                                             [channel.channel_id for channel in self.channel_states.values()],
+                                             settings.channel_info_ttl)
+        self.events_thread = None
+        self.events_ws = None
+        self.events_session_id = None
+        self.prefetcher = UserPrefetcher(self.core.cache, self.get_users_batch, self.lookup_pronouns, self.loop)
+        # An interval of 0 keeps the summarizer idle when no summary model is set
+        self.summarizer = ChatSummarizer(self.summarize_chat, self.loop,
+                                         settings.summary_interval if settings.summary_model else 0)
+        self.prompt_builders = {}
 
         self.functions = [
             # {
@@ -667,57 +3127,148 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         ]
 
         # Create IRC bot connection
-        server = 'irc.chat.twitch.tv'
-        port = 6667
+        server, port = self.endpoints['irc'].rsplit(':', 1)
+        port = int(port)
         print('Connecting to ' + server + ' on port ' + str(port) + '...')
-        app.append_to_log('Connecting to ' + server + ' on port ' + str(port) + '...')
+        self.core.log('Connecting to ' + server + ' on port ' + str(port) + '...')
         irc.bot.SingleServerIRCBot.__init__(self, [(server, port, 'oauth:' + token)], username, username)
 
-    '''
+    async def setup(self, names):
+        # Resolve the bot and every channel in as few requests as possible
+        await self.resolve_users(names + [self.username.lower()])
+        self.user_id = await self.get_channel_id(self.username)
+        await self.add_channel_states(names)
+        self.emotes = await self.get_emotes()
+
+    async def add_channel_states(self, names):
+        names = [name.lstrip('#').lower() for name in names]
+        names = [name for name in dict.fromkeys(names) if '#' + name not in self.channel_states]
+        await self.resolve_users(names)
+        added = []
+        for name in names:
+            channel = ChannelState('#' + name, await self.get_channel_id(name))
+            self.channel_states[channel.name] = channel
+            # The broadcaster gets the moderator rate limit, otherwise USERSTATE tells us once we join
+            self.send_queue.set_moderator(channel.name, self.user_id == channel.channel_id)
+            added.append(channel)
+
+        # Pick the conversation back up where the last run left it
+        journaled = await asyncio.gather(*[self.loop.run_in_executor(
+            None, self.core.journal.recent, channel.name, channel.history.entries.maxlen,
+            self.core.settings.journal_replay_age) for channel in added])
+        for channel, entries in zip(added, journaled):
+            channel.history.replay(entries)
+            channel.summary = self.core.cache.get('summary', channel.name) or ''
+        return added
+
+    def start(self):
+        # Blocks until shutdown() stops the loop
+        self._connect()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def _connect(self):
+        self.spawn(self.connect_to(self.servers.peek()))
+
+    async def connect_to(self, server):
+        try:
+            await self.connection.connect(server.host, server.port, self._nickname, server.password,
+                                          ircname=self._realname)
+        except OSError as e:
+            print('Could not connect: ' + str(e))
+            self.core.log('Could not connect: ' + str(e))
+            self.schedule_reconnect()
+
+    def _on_disconnect(self, connection, event):
+        # Replaces the irc.bot reconnect strategy, which needs the select based reactor's scheduler
+        self.channels = irc.dict.IRCDict()
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.closing or not self.core.running:
+            return
+        self.loop.call_later(self.reconnect_delay, self._connect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def spawn(self, coroutine):
+        # Keep a reference so the task isn't garbage collected, shutdown cancels whatever is left
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def call(self, coroutine, timeout=30):
+        # Run a coroutine on the bot's loop from another thread and wait for the result
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
     def receive_twitch_events(self):
-        twitch_uri = "wss://eventsub.wss.twitch.tv/ws"
+        # Set while following a session_reconnect, the session there keeps its subscriptions
+        reconnect_url = None
 
         def on_message(ws, message):
+            nonlocal reconnect_url
             data = json.loads(message)
-            print(data)
-
-            if data['metadata']['message_type'] == "PING":
-                # Respond with a pong
-                ws.send(json.dumps({"type": "PONG"}))
-                print('PONG')
-            elif data['metadata']['message_type'] == "session_welcome":
-                session_id = data['payload']['session']['id']
-                headers = {
-                    'Authorization': 'Bearer ' + app.bot_token.get(),
-                    'Client-Id': app.client_id.get(),
-                    'Content-Type': 'application/json',
-                }
-                auth_params = {
-                    'type': 'channel.channel_points_custom_reward_redemption.add',
-                    'version': '1',
-                    'condition': {"broadcaster_user_id": self.channel_id},
-                    'transport': {"method": "websocket", "session_id": session_id},
-                }
-                response = requests.post('https://api.twitch.tv/helix/eventsub/subscriptions', json=auth_params, headers=headers)
-                print(response.json())
-
-        ws = websocket.WebSocketApp(twitch_uri, on_message=on_message)
-        ws.run_forever()
-        '''
+            message_type = data['metadata']['message_type']
 
-    def verify(self):
-        url = 'https://id.twitch.tv/oauth2/validate'
-        headers = {'Authorization': 'OAuth ' + app.bot_token.get()}
-        while True:
-            response = requests.get(url, headers=headers)
+            if message_type == "session_welcome":
+                self.events_session_id = data['payload']['session']['id']
+                if reconnect_url is not None:
+                    # A reconnect URL works once, a later drop needs a new session and new subscriptions
+                    reconnect_url = None
+                    return
+                for channel in list(self.channel_states.values()):
+                    self.subscribe_channel_updates(channel, self.events_session_id)
+            elif message_type == "session_reconnect":
+                reconnect_url = data['payload']['session']['reconnect_url']
+                ws.close()
+            elif message_type == "notification" and data['metadata'].get('subscription_type') == "channel.update":
+                event = data['payload']['event']
+                self.channel_info.update(event['broadcaster_user_id'],
+                                         {'game_name': event['category_name'], 'game_id': event['category_id'],
+                                          'title': event['title']})
+                print(event['broadcaster_user_login'] + ' updated: ' + event['category_name'] + ' - ' + event['title'])
+                self.core.log(event['broadcaster_user_login'] + ' updated: ' + event['category_name'] + ' - '
+                              + event['title'])
+
+        while self.core.running and self.events_thread is not None:
+            url = reconnect_url or self.endpoints['eventsub']
+            self.events_ws = websocket.WebSocketApp(url, on_message=on_message)
+            self.events_ws.run_forever()
+            if reconnect_url == url:
+                # The reconnect URL never welcomed us, start over with a new session
+                reconnect_url = None
+            if reconnect_url is None:
+                time.sleep(1)
 
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.status_code)
+    def subscribe_channel_updates(self, channel, session_id):
+        headers = {
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
+            'Content-Type': 'application/json',
+        }
+        auth_params = {
+            'type': 'channel.update',
+            'version': '2',
+            'condition': {"broadcaster_user_id": channel.channel_id},
+            'transport': {"method": "websocket", "session_id": session_id},
+        }
+        response = self.core.http.post(self.endpoints['helix'] + '/eventsub/subscriptions',
+                                       json=auth_params, headers=headers, refresh=True)
+        print(response.json())
+
+    def stop_twitch_events(self):
+        self.events_thread = None
+        self.channel_info.stop()
+        if self.events_ws is not None:
+            self.events_ws.close()
+
+    def verify(self):
+        url = self.endpoints['auth'] + '/validate'
+        headers = {'Authorization': 'OAuth ' + self.core.settings.bot_token}
+        response = self.core.http.get(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code)
 
         # Now you can safely access the data from the response
         try:
@@ -728,104 +3279,155 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         except IndexError:
             return "Missing response data"
 
-    def get_channel_id(self, channel, **kwargs):
+    async def get_channel_id(self, channel, **kwargs):
         # Get the channel id, we will need this for v5 API calls
         print('Called get_channel_id for ' + channel)
-        app.append_to_log('Called get_channel_id for ' + channel)
-        url = 'https://api.twitch.tv/helix/users?login=' + escape(channel)
+        self.core.log('Called get_channel_id for ' + channel)
+        user = await self.get_user(channel)
+        if isinstance(user, dict):
+            return user['id']
+        return user
+
+    async def get_user(self, login, **kwargs):
+        user = self.core.cache.get('user', login.lower())
+        if user is not None:
+            return user
+
+        url = self.endpoints['helix'] + '/users?login=' + escape(login)
         headers = {
-            'Authorization': 'Bearer ' + app.bot_token.get(),
-            'Client-Id': app.client_id.get(),
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
             'Content-Type': 'application/json',
         }
 
-        while True:
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.status_code)
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code)
 
         # Now you can safely access the data from the response
         try:
-            channel_id = response.json()['data'][0]['id']
-            return channel_id
+            user = response.json()['data'][0]
+            self.core.cache.set('user', login.lower(), user)
+            return user
         except KeyError:
             return "Error parsing response data"
         except IndexError:
             return "Missing response data"
 
-    def get_game(self, channel, **kwargs):
+    async def get_users_batch(self, logins, **kwargs):
+        # Look up to 100 users in one request and cache them, logins that don't exist are left out
+        print('Called get_users_batch for ' + str(len(logins)) + ' users')
+        url = self.endpoints['helix'] + '/users?' + '&'.join('login=' + escape(login) for login in logins)
+        headers = {
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
+            'Content-Type': 'application/json',
+        }
+
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code)
+
+        try:
+            users = {user['login']: user for user in response.json()['data']}
+            self.core.cache.set_many('user', users)
+            return users
+        except KeyError:
+            return "Error parsing response data"
+
+    async def resolve_users(self, logins):
+        # Fetch uncached users 100 at a time
+        logins = [login for login in logins if self.core.cache.get('user', login) is None]
+        for start in range(0, len(logins), UserPrefetcher.BATCH_SIZE):
+            await self.get_users_batch(logins[start:start + UserPrefetcher.BATCH_SIZE])
+
+    async def get_game(self, channel, **kwargs):
         print('Called get_game for ' + channel)
-        app.append_to_log('Called get_game for ' + channel)
+        self.core.log('Called get_game for ' + channel)
+        if channel in self.channel_info:
+            return self.channel_info.get(channel, 'game_name')
         # Get the current game
-        url = 'https://api.twitch.tv/helix/channels?broadcaster_id=' + escape(channel)
+        info = await self.get_channel_info(channel)
+        if isinstance(info, dict):
+            self.channel_info.update(channel, info)
+            return info['game_name']
+        return info
+
+    async def get_channel_info(self, channel, **kwargs):
+        print('Called get_channel_info for ' + channel)
+        self.core.log('Called get_channel_info for ' + channel)
+        url = self.endpoints['helix'] + '/channels?broadcaster_id=' + escape(channel)
         headers = {
-            'Authorization': 'Bearer ' + app.bot_token.get(),
-            'Client-Id': app.client_id.get(),
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
             'Content-Type': 'application/json',
         }
-        while True:
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.status_code) + " " + str(response.content)
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code) + " " + str(response.content)
 
         # Now you can safely access the data from the response
         try:
-            game_name = response.json()['data'][0]['game_name']
-            return game_name
+            channel_info = response.json()['data'][0]
+            return channel_info
         except KeyError:
             return "Error parsing response data"
         except IndexError:
             return "Missing response data"
 
-    def get_game_info(self, game, **kwargs):
+    def get_channels_info(self, channel_ids, **kwargs):
+        # Up to 100 channels in one request, keyed by broadcaster id
+        url = self.endpoints['helix'] + '/channels?' + '&'.join('broadcaster_id=' + escape(channel_id)
+                                                                  for channel_id in channel_ids)
+        headers = {
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
+            'Content-Type': 'application/json',
+        }
+        response = self.core.http.get(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code) + " " + str(response.content)
+
+        try:
+            return {channel_info['broadcaster_id']: channel_info for channel_info in response.json()['data']}
+        except KeyError:
+            return "Error parsing response data"
+
+    async def get_game_info(self, game, **kwargs):
         print('Called get_game_info for ' + game)
-        app.append_to_log('Called get_game_info for ' + game)
-        url = 'https://api.igdb.com/v4/games'
+        self.core.log('Called get_game_info for ' + game)
+        url = self.endpoints['igdb'] + '/games'
         headers = {
             'Authorization': 'Bearer ' + self.client_credentials['access_token'],
-            'Client-Id': app.client_id.get(),
+            'Client-Id': self.core.settings.client_id,
             'Content-Type': 'application/json',
         }
         data = 'fields *; where name ~ "' + escape(game) + '";'
         print(data)
-        response = requests.post(url, headers=headers, data=data)
+        response = await self.core.http.apost(url, headers=headers, data=data)
         print(response)
         game_info = json.dumps(response.json())
         print(game_info)
         return game_info
 
-    def get_emotes(self, **kwargs):
+    async def get_emotes(self, **kwargs):
         # Get list of global emotes
         print('Called get_emotes')
-        app.append_to_log('Called get_emotes')
-        url = 'https://api.twitch.tv/helix/chat/emotes/global'
+        self.core.log('Called get_emotes')
+        url = self.endpoints['helix'] + '/chat/emotes/global'
         headers = {
-            'Authorization': 'Bearer ' + app.bot_token.get(),
-            'Client-Id': app.client_id.get(),
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
             'Content-Type': 'application/json',
         }
-        while True:
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.status_code)
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code)
 
         # Now you can safely access the data from the response
         try:
@@ -838,27 +3440,21 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         except IndexError:
             return "Missing response data"
 
-    def get_stream(self, streamer, **kwargs):
-        print('Called get_stream for ' + streamer)
-        app.append_to_log('Called get_stream for ' + streamer)
+    async def get_stream(self, streamer, channel=None, **kwargs):
         if streamer == None:
-            streamer = self.channel[1:]
-        url = 'https://api.twitch.tv/helix/search/channels?query=' + escape(streamer) + '&first=1'
+            streamer = (channel or self.primary_channel.name)[1:]
+        print('Called get_stream for ' + streamer)
+        self.core.log('Called get_stream for ' + streamer)
+        url = self.endpoints['helix'] + '/search/channels?query=' + escape(streamer) + '&first=1'
         headers = {
-            'Authorization': 'Bearer ' + app.bot_token.get(),
-            'Client-Id': app.client_id.get(),
+            'Authorization': 'Bearer ' + self.core.settings.bot_token,
+            'Client-Id': self.core.settings.client_id,
             'Content-Type': 'application/json',
         }
-        while True:
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.status_code)
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.status_code)
 
         # Now you can safely access the data from the response
         try:
@@ -870,26 +3466,20 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         except IndexError:
             return "Missing response data"
 
-    def get_followage(self, user, **kwargs):
+    async def get_followage(self, user, channel=None, **kwargs):
         print('Called get_followage for ' + user)
-        app.append_to_log('Called get_followage for ' + user)
+        self.core.log('Called get_followage for ' + user)
 
-        headers = {'Authorization': 'Bearer ' + app.bot_token.get(),
-                   'Client-ID': app.client_id.get(),
+        headers = {'Authorization': 'Bearer ' + self.core.settings.bot_token,
+                   'Client-ID': self.core.settings.client_id,
                    'Content-Type': 'application/json'}
-        url = 'https://api.twitch.tv/helix/channels/followers?user_id=' + escape(self.get_channel_id(
-            user)) + '&broadcaster_id=' + escape(self.channel_id)
+        url = self.endpoints['helix'] + '/channels/followers?user_id=' + escape(await self.get_channel_id(
+            user)) + '&broadcaster_id=' + escape(self.channel_states[channel or self.primary_channel.name].channel_id)
 
-        while True:
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                app.refresh_login()
-            else:
-                # Handle other status codes if needed
-                return "Error fetching data: " + str(response.json()['message'])
+        response = await self.core.http.aget(url, headers=headers, refresh=True)
+        if response.status_code != 200:
+            # Handle other status codes if needed
+            return "Error fetching data: " + str(response.json()['message'])
 
         # Now you can safely access the data from the response
         try:
@@ -900,84 +3490,146 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         except IndexError:
             return "Not Following"
 
-    def get_users(self, **kwargs):
+    async def get_users(self, channel=None, **kwargs):
         print('Called get_users')
-        app.append_to_log('Called get_users')
-        self.connection.users()
-        if app.ignore_userlist.get() == 1:
+        self.core.log('Called get_users')
+        if self.core.settings.ignore_userlist == 1:
             return 'unknown'
         else:
-            return str(app.user_list.get(0, tk.END))
+            return ', '.join(self.channel_states[channel or self.primary_channel.name].roster.logins())
 
-    def on_namreply(self, c, e):
-        for key in self.channels[self.channel].users():
-            if key not in self.users:
-                self.users.append(key)
+    def shutdown(self):
+        # Called from another thread while the loop runs, or after KeyboardInterrupt stopped it
+        if self.loop.is_closed():
+            return
+        if self.loop.is_running():
+            try:
+                self.call(self.close(), 10)
+            except Exception as e:
+                print(e)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self.loop.run_until_complete(self.close())
+            self.loop.close()
 
-        for user in self.users:
-            if user not in str(app.user_list.get(0, tk.END)):
-                app.user_list.insert(tk.END, user)
+    async def close(self):
+        self.closing = True
+        try:
+            self.disconnect()
+        except Exception as e:
+            print(e)
+        self.scheduler.stop()
+        print('Replies: ' + str(self.scheduler.stats()))
+        self.send_queue.stop()
+        print('Sent: ' + str(self.send_queue.stats()))
+        self.stop_twitch_events()
+        self.prefetcher.stop()
+        self.summarizer.stop()
+        for channel in self.channel_states.values():
+            channel.roster.clear()
+        for task in list(self.tasks):
+            if task is not asyncio.current_task():
+                task.cancel()
+        await self.core.http.aclose()
 
-        app.user_count.config(text=app.user_list.size())
+    def on_namreply(self, c, e):
+        channel = self.channel_states.get(e.arguments[1])
+        if channel is None:
+            return
+        users = list(self.channels[channel.name].users())
+        self.prefetcher.add(users)
+        added = [user.lower() for user in users if channel.roster.add(user)]
+        if added:
+            self.core.add_users(channel.name, added)
 
-        print(', '.join(map(str, self.users)))
+        print(channel.name + ': ' + ', '.join(channel.roster.logins()))
 
     def on_join(self, c, e):
-        user = e.source.nick
-        if user not in str(app.user_list.get(0, tk.END)):
-            self.users.append(user)
-            app.user_list.insert(tk.END, user)
-            app.user_count.config(text=app.user_list.size())
-            print(user + ' joined')
+        channel = self.channel_states.get(e.target)
+        if channel is None:
+            return
+        user = e.source.nick.lower()
+        self.prefetcher.add([user])
+        if channel.roster.add(user):
+            self.core.add_users(channel.name, [user])
+            print(user + ' joined ' + channel.name)
 
     def on_part(self, c, e):
-        user = e.source.nick
-        if user in str(self.users):
-            self.users.remove(user)
-            for index in range(app.user_list.size(), -1, -1):
-                item_name = app.user_list.get(index)
-                if item_name == user:
-                    app.user_list.delete(index)
-            app.user_count.config(text=app.user_list.size())
-            print(user + ' left')
+        channel = self.channel_states.get(e.target)
+        if channel is None:
+            return
+        user = e.source.nick.lower()
+        if channel.roster.remove(user):
+            self.core.remove_user(channel.name, user)
+            print(user + ' left ' + channel.name)
 
     def on_welcome(self, c, e):
-        print('Joining ' + self.channel)
-        app.append_to_log('Joining ' + self.channel)
         self.connection = c
+        self.reconnect_delay = 2
 
         # You must request specific capabilities before you can use them
         c.cap('REQ', ':twitch.tv/membership')
         c.cap('REQ', ':twitch.tv/tags')
         c.cap('REQ', ':twitch.tv/commands')
-        c.join(self.channel)
-
-        self.connection.users()
-
-        '''
-        thread = threading.Thread(target=self.receive_twitch_events)
-        thread.start()
-        thread.join()
-        '''
-
-    def get_launch(self, when, **kwargs):
+        self.join_channels(list(self.channel_states))
+
+        # Keep the cached channel info current, on_welcome runs again after every reconnect
+        if self.events_thread is None:
+            self.events_thread = threading.Thread(target=self.receive_twitch_events)
+            self.events_thread.daemon = True
+            self.events_thread.start()
+
+    def join_channels(self, names):
+        # Joins are paced by the account's JOIN budget, which shards share
+        async def run_joins():
+            for name in names:
+                wait = self.core.join_budget.acquire()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.core.join_budget.acquire()
+                if not self.connection.is_connected():
+                    return
+                print('Joining ' + name)
+                self.core.log('Joining ' + name)
+                self.connection.join(name)
+
+        self.spawn(run_joins())
+
+    async def add_channels(self, names):
+        # Run on the bot's loop by a shard worker when the supervisor moves channels to it
+        added = await self.add_channel_states(names)
+        self.channel_info.add([channel.channel_id for channel in added])
+        if self.events_session_id is not None:
+            for channel in added:
+                await self.loop.run_in_executor(None, self.subscribe_channel_updates, channel,
+                                                self.events_session_id)
+        if self.connection.is_connected():
+            self.join_channels([channel.name for channel in added])
+
+    async def get_launch(self, when, **kwargs):
         print('Called get_launch on ' + when)
-        app.append_to_log('Called get_launch on ' + when)
+        self.core.log('Called get_launch on ' + when)
         if when == 'next':
-            url = 'https://ll.thespacedevs.com/2.2.0/launch/upcoming/?mode=list'
+            url = self.endpoints['launches'] + '/launch/upcoming/?mode=list'
         else:
-            url = 'https://ll.thespacedevs.com/2.2.0/launch/previous/?mode=list'
-        return json.dumps(requests.get(url).json()["results"][:2])
+            url = self.endpoints['launches'] + '/launch/previous/?mode=list'
+        return json.dumps((await self.core.http.aget(url)).json()["results"][:2])
 
-    def get_pronouns(self, author, **kwargs):
+    async def get_pronouns(self, author, **kwargs):
         print('Called get_pronouns for ' + author)
-        app.append_to_log('Called get_pronouns for ' + author)
+        self.core.log('Called get_pronouns for ' + author)
         # Check if pronouns exist in the cache
-        if author.lower() in self.pronoun_cache:
-            return self.pronoun_cache[author.lower()]
+        pronoun = self.core.cache.get('pronouns', author.lower())
+        if pronoun is not None:
+            return pronoun
+
+        pronoun = await self.lookup_pronouns(author)
+        self.core.log('Got ' + author + ' pronouns ' + pronoun)
+        return pronoun
 
-        url = 'https://pronouns.alejo.io/api/users/' + escape(author.lower())
-        r = requests.get(url).json()
+    async def lookup_pronouns(self, author):
+        url = self.endpoints['pronouns'] + '/users/' + escape(author.lower())
+        r = (await self.core.http.aget(url, endpoint='pronouns.alejo.io/api/users')).json()
 
         pronoun_mapping = {
             'aeaer': 'Ae/Aer',
@@ -1002,67 +3654,125 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         pronoun = pronoun_mapping.get(pronouns, 'unknown')
 
         print('Got ' + author + ' pronouns ' + pronoun)
-        app.append_to_log('Got ' + author + ' pronouns ' + pronoun)
 
-        self.pronoun_cache[author.lower()] = pronoun
+        self.core.cache.set('pronouns', author.lower(), pronoun)
 
         return pronoun
 
-    def parse_string(self, input_string, author, user_message):
-        replacements = {
-            "<name>": self.username,
-            "<channel>": self.channel[1:],
-            "<game>": self.get_game(self.channel_id),
-            "<author>": author,
-            "<emotes>": ', '.join(map(str, self.emotes)),
-            "<UTC>": str(datetime.now(timezone.utc)),
-            "<time>": str(datetime.now()),
-            "<chatter_pronouns>": self.get_pronouns(author),
-            "<streamer_pronouns>": self.get_pronouns(self.channel[1:]),
-            "<users>": ', '.join(map(str, self.get_users()))
+    async def parse_string(self, input_string, channel, author, user_message):
+        channel = self.channel_states[channel]
+        if channel.prompt_template.text != input_string:
+            channel.prompt_template = PromptTemplate(input_string)
+        template = channel.prompt_template
+
+        # Only tags that appear in the context are resolved, the ones that may hit the network run concurrently
+        resolvers = {
+            "name": lambda: self.username,
+            "channel": lambda: channel.name[1:],
+            "game": lambda: self.channel_info.get(channel.channel_id, 'game_name'),
+            "author": lambda: author,
+            "UTC": lambda: str(datetime.now(timezone.utc)),
+            "time": lambda: str(datetime.now()),
+        }
+        coroutine_resolvers = {
+            "chatter_pronouns": lambda: self.get_pronouns(author),
+            "streamer_pronouns": lambda: self.get_pronouns(channel.name[1:]),
         }
 
-        for placeholder, replacement in replacements.items():
-            input_string = input_string.replace(placeholder, replacement)
-
-        sentences = input_string.split('. ')
-        parsed_list = [{"role": "system", "content": sentence} for sentence in sentences]
-
-        for m in self.message_queue:
-            if m.split(': ')[0] == self.username.lower():
-                parsed_list.append({"role": "assistant", "content": m.split(': ')[1]})
-            elif m.split(': ')[1] != user_message:
-                parsed_list.append({"role": "system", "name": m.split(': ')[0], "content": m.split(': ')[1]})
-
-        if app.openai_api_model.get() == 'mpt-7b-chat' or app.openai_api_model.get() == 'WizardLM-13B':
+        latency = self.core.latency
+        values = {}
+        for tag in template.tags:
+            if tag in resolvers:
+                with latency.span('tag ' + tag):
+                    values[tag] = resolvers[tag]()
+        tags = [tag for tag in template.tags if tag in coroutine_resolvers]
+        results = await asyncio.gather(*[self.timed('tag ' + tag, coroutine_resolvers[tag]()) for tag in tags])
+        values.update(zip(tags, results))
+
+        # The emote and user lists are left to the prompt builder, which shortens them when they don't fit
+        emotes = [str(emote) for emote in self.emotes] if isinstance(self.emotes, list) else []
+        with latency.span('user list'):
+            users = 'unknown' if self.core.settings.ignore_userlist == 1 else channel.roster.logins()
+
+        history = channel.history.completion(author, user_message)
+        speakers = channel.history.speakers()
+
+        model = self.core.settings.model
+        if model not in self.prompt_builders:
+            self.prompt_builders[model] = PromptBuilder(model)
+        builder = self.prompt_builders[model]
+        with latency.span('prompt build'):
+            parsed_list, sections = builder.build(template, values, emotes, users, speakers, history, user_message,
+                                                  builder.budget(self.core.settings.prompt_token_budget),
+                                                  channel.summary)
+
+        breakdown = ('Prompt tokens for ' + author + ': ' + ', '.join(
+            section + ' ' + str(sections[section])
+            for section in ('context', 'emotes', 'users', 'summary', 'history', 'message'))
+            + ', total ' + str(sections['total']) + '/' + str(sections['budget']))
+        if sections['degraded']:
+            breakdown += ' (shortened ' + ', '.join(sections['degraded']) + ')'
+        print(breakdown)
+        self.core.log(breakdown)
+
+        if model in LOCAL_MODELS:
             return parsed_list
         parsed_list.append({"role": "user", "name": author, "content": user_message})
         return parsed_list
 
-    def send_message_delayed(self, message, delay_seconds, **kwargs):
+    async def summarize_chat(self, channel, summary, lines):
+        # Called by the summarizer, returns the new summary or None to try again later
+        model = self.core.settings.summary_model
+        if not model:
+            return None
+        prompt = ('Summary so far: ' + summary + '\n\n' if summary else '') + 'New messages:\n' + '\n'.join(
+            entry.author + ': ' + entry.text for entry in lines)
+
+        if model in LOCAL_MODELS:
+            # Replies come first, the local model only summarizes when it has nothing else to do
+            if not self.core.inference_server.idle():
+                return None
+            response = await self.core.inference_server.agenerate(
+                model, [{"role": "system", "content": self.SUMMARY_PROMPT}], prompt)
+            self.core.metrics.inc('pywiki_summaries_total', backend='local', model=model)
+        else:
+            openai.aiosession.set(self.core.http.get_async_session())
+            messages = [{"role": "system", "content": self.SUMMARY_PROMPT}, {"role": "user", "content": prompt}]
+            completion = await asyncio.wait_for(openai.ChatCompletion.acreate(
+                model=model,
+                messages=messages,
+                max_tokens=self.SUMMARY_TOKENS,
+                temperature=0.3,
+                user=channel[1:]), self.OPENAI_TIMEOUT)
+            response = completion["choices"][0]["message"].get("content")
+            self.count_tokens(model, completion.get("usage"), messages, response or '')
+            self.core.metrics.inc('pywiki_summaries_total', backend='openai', model=model)
+
+        summary = (response or '').strip()[:self.SUMMARY_CHARS]
+        if not summary:
+            return None
+        self.core.cache.set('summary', channel, summary)
+        print('Summarized ' + str(len(lines)) + ' lines of ' + channel + ': ' + summary)
+        self.core.log('Summarized ' + str(len(lines)) + ' lines of ' + channel)
+        return summary
+
+    async def send_message_delayed(self, message, delay_seconds, channel=None, **kwargs):
         print('Called send_message_delayed ' + message + ' in ' + delay_seconds + ' seconds')
-        app.append_to_log('Called send_message_delayed ' + message + ' in ' + delay_seconds + ' seconds')
+        self.core.log('Called send_message_delayed ' + message + ' in ' + delay_seconds + ' seconds')
 
-        def delayed_print():
-            seconds = int(delay_seconds)
-            while seconds > 0 and app.bot_running:
-                time.sleep(1)
-                seconds -= 1
-            if app.bot_running:
-                self.connection.privmsg(self.channel, message)
-                app.append_to_log(self.username + ': ' + message)
-                print(self.username + ': ' + message)
-                self.message_queue.append(self.username + ': ' + message)
-
-        thread = threading.Thread(target=delayed_print)
-        thread.start()
+        async def delayed_print():
+            await asyncio.sleep(int(delay_seconds))
+            if self.core.running:
+                self.send_message(channel or self.primary_channel.name, message)
+
+        self.spawn(delayed_print())
 
         return 'Timer Set'
 
     def on_disconnect(self, c, e):
-        self.message_queue.clear()
+        # The chat history is kept, the conversation carries on after the reconnect
         print('Disconnected')
-        app.append_to_log('Disconnected')
+        self.core.log('Disconnected')
 
     def on_ctcp(self, c, e):
         nick = e.source.nick
@@ -1083,112 +3793,104 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
                 author = tag['value']
                 break
         print(author + " " + message)
-        app.append_to_log((author + " " + message))
+        self.core.log((author + " " + message))
 
     def on_pubmsg(self, c, e):
         message = e.arguments[0]
 
-        author = ''
-        for tag in e.tags:
-            if tag['key'] == 'display-name':
-                author = tag['value']
-                break
+        tags = {tag['key']: tag['value'] for tag in e.tags or []}
+        login = e.source.nick.lower() if e.source else ''
+        author = tags.get('display-name') or login
+        channel = self.channel_states.get(e.target)
+        if channel is None:
+            return
         print(author + ": " + message)
-        app.append_to_log(author + ": " + message)
-        self.message_queue.append(author + ": " + message)
-        self.last_message[author.lower()] = message
-
-        if author.lower() not in str(app.user_list.get(0, tk.END)):
-            self.users.append(author.lower())
-            app.user_list.insert(tk.END, author.lower())
-            app.user_count.config(text=app.user_list.size())
+        self.core.log(author + ": " + message)
+        self.core.metrics.inc('pywiki_messages_received_total', channel=channel.name)
+        sent_at = tags.get('tmi-sent-ts')
+        sent_at = int(sent_at) / 1000 if sent_at and sent_at.isdigit() else None
+        self.core.journal.append(channel.name, channel.history.add(author, message, timestamp=sent_at,
+                                                                   message_id=tags.get('id'), login=login))
+        self.summarizer.check(channel)
+        # Keyed by login, like the GUI's user list
+        channel.last_message[login] = message
+        self.prefetcher.add([login])
+
+        if channel.roster.seen(login):
+            self.core.add_users(channel.name, [login])
 
         # If a chat message starts with an exclamation point, try to run it as a command
         if e.arguments[0].startswith('!'):
             cmd = e.arguments[0][1:].split()
             if len(cmd) > 0:
                 print('Received command: ' + cmd[0])
-                app.append_to_log('Received command: ' + cmd[0])
+                self.core.log('Received command: ' + cmd[0])
                 self.do_command(e, cmd)
             return
 
         rand_chat = random.random()
-        if app.mute and rand_chat > float(app.frequency_slider.get()) / 100:
+        frequency = self.core.settings.frequency_for(channel.name)
+        if self.core.settings.mute and rand_chat > frequency / 100:
             return
 
         elif message.lower() == (self.username + " yes").lower() or message.lower() == \
                 ('@' + self.username + " yes").lower():
-            c.privmsg(self.channel, ":)")
-            app.append_to_log(self.username + ': ' + ":)")
+            self.send_message(channel.name, ":)", remember=False)
         elif message.lower() == (self.username + " no").lower() or message.lower() == \
                 ('@' + self.username + " no").lower():
-            c.privmsg(self.channel, ":(")
-            app.append_to_log(self.username + ': ' + ":(")
+            self.send_message(channel.name, ":(", remember=False)
         elif message.lower().startswith(("thanks " + self.username).lower()) or \
                 message.lower().startswith(("thanks @" + self.username).lower()):
-            c.privmsg(self.channel, "np")
-            app.append_to_log(self.username + ': ' + "np")
+            self.send_message(channel.name, "np", remember=False)
         else:
-            if rand_chat <= float(app.frequency_slider.get()) / 100 or self.username.lower() in message.lower() or \
-                    "@" + self.username.lower() in message.lower():
-                thread = threading.Thread(target=lambda: self.generate_response(author, message))
-                thread.start()
-
-    def generate_response(self, author, message):
-        self.input_text = app.input_text.get('1.0', 'end')
-
-        if app.openai_api_model.get() == 'mpt-7b-chat' or app.openai_api_model.get() == 'WizardLM-13B':
+            if self.username.lower() in message.lower():
+                self.request_reply(ResponseScheduler.MENTION, channel.name, author, message)
+            elif rand_chat <= frequency / 100:
+                self.request_reply(ResponseScheduler.RANDOM, channel.name, author, message)
+
+    def request_reply(self, priority, channel, author, message):
+        # The GUI calls this from its own thread
+        self.loop.call_soon_threadsafe(self.scheduler.submit, priority, (channel, author.lower()), channel, author,
+                                       message)
+
+    async def generate_response(self, channel, author, message):
+        input_text = self.core.settings.context_for(channel)
+        model = self.core.settings.model
+        metrics = self.core.metrics
+
+        if model in LOCAL_MODELS:
             try:
-                if app.openai_api_model.get() == 'mpt-7b-chat':
-                    gmll_model = 'ggml-mpt-7b-chat.bin'
-                else:
-                    gmll_model = 'wizardlm-13b-v1.1-superhot-8k.ggmlv3.q4_0.bin'
-
-                with io.StringIO() as buffer, redirect_stdout(buffer):
-                    self.model4a = gpt4all.GPT4All(model_name=gmll_model,
-                                                   model_path=os.path.abspath('.'),
-                                                   allow_download=False)
-                    output = buffer.getvalue().strip()
-                app.append_to_log(output)
-                print(output)
-
-                with self.model4a.chat_session():
-                    self.model4a.current_chat_session = self.parse_string(self.input_text, author, message)
-                    response = self.model4a.generate(message, max_tokens=500, temp=0.7).encode('ascii',
-                                                                                               'ignore').decode('ascii')
-
-                response = response.strip().replace('\r', ' ').replace('\n', ' ')
-                while response.startswith('.') or response.startswith('/'):
-                    response = response[1:]
-                if response.lower().startswith(self.username.lower()):
-                    response = response[len(self.username + ': '):]
-                while len(('PRIVMSG' + self.channel + " " + response + '\r\n').encode()) > 488:
-                    response = response[:-1]
-
-                self.connection.privmsg(self.channel, response[:500])
-                app.append_to_log(self.username + ': ' + response[:500])
-                print(self.username + ': ' + response[:500])
-                self.message_queue.append(self.username + ': ' + response[:500])
-
+                message_array = await self.timed('prompt', self.parse_string(input_text, channel, author, message))
+                response = await self.timed('local model', self.core.inference_server.agenerate(
+                    self.core.settings.model, message_array, message))
+                with self.core.latency.span('trim'):
+                    response = response.encode('ascii', 'ignore').decode('ascii')
+                    reply = self.trim_reply(channel, self.clean_reply(response))
+                self.send_message(channel, reply)
+                metrics.inc('pywiki_replies_total', backend='local', model=model)
+
+            except InferenceBusy as e:
+                print('Skipped reply to ' + author + ': ' + str(e))
+                self.core.log('Skipped reply to ' + author + ': ' + str(e))
+                metrics.inc('pywiki_reply_failures_total', backend='local', reason='busy')
+            except (CancelledError, asyncio.CancelledError):
+                print('Cancelled reply to ' + author)
+                metrics.inc('pywiki_reply_failures_total', backend='local', reason='cancelled')
             except Exception as e:
+                metrics.inc('pywiki_reply_failures_total', backend='local', reason='error')
                 print(str(e))
                 print(traceback.format_exc())
-                app.append_to_log(str(e))
-                app.append_to_log(traceback.format_exc())
+                self.core.log(str(e))
+                self.core.log(traceback.format_exc())
 
         else:
             retry = 0
             while retry < 3:
-                message_array = self.parse_string(self.input_text, author, message)
+                message_array = await self.timed('prompt', self.parse_string(input_text, channel, author, message))
 
                 try:
-                    response = openai.ChatCompletion.create(model=app.openai_api_model.get(),
-                                                            messages=message_array,
-                                                            functions=self.functions,
-                                                            user=self.channel[1:]
-                                                            )
-
-                    response_message = response["choices"][0]["message"]
+                    response_message = await self.timed('completion',
+                                                        self.complete_chat(channel, message_array, self.functions))
 
                     # Step 2: check if GPT wanted to call a function
                     if response_message.get("function_call"):
@@ -1205,14 +3907,15 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
                         function_name = response_message["function_call"]["name"]
                         function_to_call = available_functions[function_name]
                         function_args = json.loads(response_message["function_call"]["arguments"])
-                        function_response = function_to_call(
+                        function_response = await self.timed('function ' + function_name, function_to_call(
                             # author=function_args.get("user"),
                             when=function_args.get("when"),
                             streamer=function_args.get("streamer"),
                             game=function_args.get("game"),
                             message=function_args.get("message"),
-                            delay_seconds=function_args.get("delay_seconds")
-                        )
+                            delay_seconds=function_args.get("delay_seconds"),
+                            channel=channel
+                        ))
 
                         # Step 4: send the info on the function call and function response to GPT
                         message_array.append(response_message)  # extend conversation with assistant's reply
@@ -1224,56 +3927,192 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
                                 "content": function_response,
                             }
                         )  # extend conversation with function response
-                        response = openai.ChatCompletion.create(
-                            model=app.openai_api_model.get(),
-                            messages=message_array,
-                        )  # get a new response from GPT where it can see the function response
-
-                    if hasattr(response, 'choices'):
-                        response.choices[0].message.content = \
-                            response.choices[0].message.content.strip().replace('\r', ' ').replace('\n', ' ')
-                        while response.choices[0].message.content.startswith('.') or \
-                                response.choices[0].message.content.startswith('/'):
-                            response.choices[0].message.content = response.choices[0].message.content[1:]
-                        if response.choices[0].message.content.lower().startswith(self.username.lower()):
-                            response.choices[0].message.content = response.choices[0].message.content[
-                                                                  len(self.username + ': '):]
-                        while len(('PRIVMSG' + self.channel + " " + response.choices[
-                            0].message.content + '\r\n').encode()) > 488:
-                            response.choices[0].message.content = response.choices[0].message.content[:-1]
-                        self.connection.privmsg(self.channel, response.choices[0].message.content[:500])
-                        app.append_to_log(self.username + ': ' + response.choices[0].message.content[:500])
-                        print(self.username + ': ' + response.choices[0].message.content[:500])
-                        self.message_queue.append(self.username + ': ' + response.choices[0].message.content[:500])
+                        # get a new response from GPT where it can see the function response
+                        response_message = await self.timed('completion after function',
+                                                            self.complete_chat(channel, message_array))
+
+                    if response_message.get("content"):
+                        with self.core.latency.span('trim'):
+                            reply = self.trim_reply(channel, self.clean_reply(response_message["content"]))
+                        self.send_message(channel, reply)
+                        metrics.inc('pywiki_replies_total', backend='openai', model=model)
                         break
                     else:
-                        print(response)
-                        app.append_to_log(response)
+                        retry += 1
+                        metrics.inc('pywiki_reply_failures_total', backend='openai', reason='empty')
+                        print(response_message)
+                        self.core.log(response_message)
 
                 except Exception as e:
                     retry += 1
+                    metrics.inc('pywiki_reply_failures_total', backend='openai', reason='error')
                     print(str(e))
                     print(traceback.format_exc())
-                    app.append_to_log(str(e))
-                    app.append_to_log(traceback.format_exc())
+                    self.core.log(str(e))
+                    self.core.log(traceback.format_exc())
+                    # Rate limited or overloaded, wait like the HTTP client would before asking again
+                    status = getattr(e, 'http_status', None) or 0
+                    if retry < 3 and (status == 429 or status >= 500):
+                        await asyncio.sleep(self.core.http.backoff(retry - 1, e))
+
+    async def timed(self, stage, coroutine):
+        with self.core.latency.span(stage):
+            return await coroutine
+
+    async def complete_chat(self, channel, messages, functions=None):
+        if self.core.settings.stream_replies:
+            return await self.stream_chat(channel, messages, functions)
+        extra = {'functions': functions} if functions else {}
+        # Share the pooled aiohttp session instead of opening one per request
+        openai.aiosession.set(self.core.http.get_async_session())
+        response = await asyncio.wait_for(openai.ChatCompletion.acreate(model=self.core.settings.model,
+                                                                        messages=messages,
+                                                                        user=channel[1:],
+                                                                        **extra), self.OPENAI_TIMEOUT)
+        message = response["choices"][0]["message"]
+        self.count_tokens(self.core.settings.model, response.get("usage"), messages, message.get("content") or '')
+        return message
+
+    def count_tokens(self, model, usage=None, messages=(), reply=''):
+        # Streamed completions don't report usage, their tokens are counted like the prompt builder counts them
+        if usage is None:
+            if model not in self.prompt_builders:
+                self.prompt_builders[model] = PromptBuilder(model)
+            builder = self.prompt_builders[model]
+            usage = {'prompt_tokens': sum(builder.count(message.get("content") or '') + builder.MESSAGE_OVERHEAD
+                                          for message in messages),
+                     'completion_tokens': builder.count(reply)}
+        for kind in ('prompt', 'completion'):
+            self.core.metrics.inc('pywiki_tokens_total', usage.get(kind + '_tokens', 0), model=model, kind=kind)
+
+    async def stream_chat(self, channel, messages, functions=None):
+        # Read the reply as it is generated and hang up once it has outgrown one chat message, so the tokens that
+        # would be trimmed anyway are never generated. Returns the message like a non streamed completion would.
+        # Goes through the HTTP client, the openai package has no way to close a stream's connection early.
+        body = {'model': self.core.settings.model, 'messages': messages, 'user': channel[1:], 'stream': True}
+        if functions:
+            body['functions'] = functions
+        headers = {'Authorization': 'Bearer ' + openai.api_key, 'Content-Type': 'application/json'}
+        if openai.organization:
+            headers['OpenAI-Organization'] = openai.organization
+
+        content = ''
+        function_call = None
+        started = time.perf_counter()
+        async with self.core.http.astream('POST', openai.api_base + '/chat/completions', headers=headers,
+                                          json=body, timeout=self.OPENAI_TIMEOUT) as response:
+            if response.status != 200:
+                raise CompletionError(response.status, response.headers, await response.text())
+            async for line in response.content:
+                if not line.startswith(b'data: '):
+                    continue
+                data = line[len(b'data: '):].strip()
+                if data == b'[DONE]':
+                    break
+                delta = json.loads(data)["choices"][0]["delta"]
+                if started is not None and (delta.get("function_call") or delta.get("content")):
+                    self.core.latency.record('first token', time.perf_counter() - started)
+                    started = None
+                if delta.get("function_call"):
+                    function_call = function_call or {"name": '', "arguments": ''}
+                    function_call["name"] += delta["function_call"].get("name") or ''
+                    function_call["arguments"] += delta["function_call"].get("arguments") or ''
+                elif delta.get("content"):
+                    content += delta["content"]
+                    if not self.reply_fits(channel, self.clean_reply(content)):
+                        break
+
+        self.count_tokens(body['model'], None, messages, function_call["arguments"] if function_call else content)
+        if function_call is not None:
+            return {"role": "assistant", "content": None, "function_call": function_call}
+        return {"role": "assistant", "content": content}
+
+    def clean_reply(self, text):
+        text = text.strip().replace('\r', ' ').replace('\n', ' ')
+        while text.startswith('.') or text.startswith('/'):
+            text = text[1:]
+        if text.lower().startswith(self.username.lower()):
+            text = text[len(self.username + ': '):]
+        return text
+
+    def reply_fits(self, channel, text):
+        return len(('PRIVMSG' + channel + " " + text + '\r\n').encode()) <= self.MESSAGE_BYTES
+
+    def trim_reply(self, channel, text):
+        if self.reply_fits(channel, text):
+            return text[:500]
+        budget = self.MESSAGE_BYTES - len(('PRIVMSG' + channel + " " + '\r\n').encode())
+        text = text.encode()[:budget].decode('utf-8', 'ignore')
+        # End on a whole sentence when that keeps most of the reply
+        ends = [match.end() for match in self.SENTENCE_END.finditer(text)]
+        if ends and ends[-1] >= len(text) // 2:
+            text = text[:ends[-1]]
+        return text[:500]
+
+    def send_message(self, channel, message, remember=True):
+        self.send_queue.put(channel, message, remember)
+
+    def write_message(self, channel, message, remember=True):
+        # Called from the send queue once the rate limit allows it
+        self.connection.privmsg(channel, message)
+        self.core.log(self.username + ': ' + message)
+        print(self.username + ': ' + message)
+        if remember and channel in self.channel_states:
+            state = self.channel_states[channel]
+            self.core.journal.append(channel, state.history.add(self.username, message, 'assistant'))
+            self.summarizer.check(state)
+
+    def on_userstate(self, c, e):
+        badges = ''
+        moderator = False
+        for tag in e.tags:
+            if tag['key'] == 'mod':
+                moderator = tag['value'] == '1'
+            elif tag['key'] == 'badges':
+                badges = tag['value'] or ''
+        channel = self.channel_states.get(e.target)
+        if channel is not None:
+            self.send_queue.set_moderator(channel.name, moderator or 'broadcaster/' in badges
+                                          or self.user_id == channel.channel_id)
 
     def do_command(self, e, cmd):
-        c = self.connection
         if len(cmd) == 2:
             if cmd[0] == self.username and cmd[1] == 'version':
-                c.privmsg(self.channel, get_version() + ' ' + app.openai_api_model.get())
-                app.append_to_log(self.username + ': ' + get_version() + ' ' + app.openai_api_model.get())
-                print(self.username + ': ' + get_version() + ' ' + app.openai_api_model.get())
+                self.send_message(e.target, get_version() + ' ' + self.core.settings.model, remember=False)
+            elif cmd[0] == self.username and cmd[1] == 'stats':
+                self.send_message(e.target, self.core.latency.line(), remember=False)
+        if 2 <= len(cmd) <= 3 and cmd[0] == self.username and cmd[1] == 'profile' and self.is_moderator(e):
+            seconds = int(cmd[2]) if len(cmd) == 3 and cmd[2].isdigit() else None
+            path = self.core.profile(min(seconds, self.MAX_PROFILE_SECONDS) if seconds else None)
+            self.send_message(e.target, 'Profiling into ' + os.path.basename(path) if path is not None
+                              else 'Already profiling', remember=False)
+
+    def is_moderator(self, e):
+        tags = {tag['key']: tag['value'] for tag in e.tags or []}
+        return tags.get('mod') == '1' or 'broadcaster/' in (tags.get('badges') or '')
 
 
 if __name__ == "__main__":
+    # Needed for the inference process in the PyInstaller build
+    multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(description="pyWiki Lite")
     parser.add_argument("--version", action="store_true", help="Show the version number")
+    parser.add_argument("--headless", action="store_true", help="Run the bot without the GUI")
+    parser.add_argument("--config", default="config.ini", help="Configuration file to use in headless mode")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split the channels across this many bot processes (headless)")
     args = parser.parse_args()
 
     if args.version:
         print(get_version())
         sys.exit()
 
+    if args.shards > 1:
+        sys.exit(run_sharded(args.config, args.shards))
+
+    if args.headless:
+        sys.exit(run_headless(args.config))
+
     app = TwitchBotGUI()
     app.mainloop()